@@ -0,0 +1,130 @@
+# Micro-benchmarks to be run after performance related code modifications
+# `python benchmark.py`
+# Uses a synthetic library, so none of the paths in convert.py need to be set.
+
+import contextlib, io, random, re, time, tracemalloc
+from convert import *
+
+def synthetic_library(num_files=20000, seed=1):
+    rng = random.Random(seed)
+    words = ["love", "night", "rock", "blue", "heart", "fire", "dance", "moon", "rain", "road", "&amp;", "the", "of", "my", "song", "light", "time", "dream"]
+    make = lambda n: " ".join(rng.choice(words) for _ in range(rng.randint(1, n)))
+    infos = []
+    for i in range(num_files):
+        artist, album, title = make(2), make(3), make(4)
+        path = "/music/{}/{}/{:02d} {}.mp3".format(artist, album, i % 20, title)
+        infos.append(FileInfo(full_path=path, filename=os.path.basename(path), tag=FileTag(artist=artist, album=album, title=title)))
+    songs = [SongInfo(title=make(4), artist=make(2), album=make(3), liked=False, title_stripped="") for _ in range(100)]
+    return infos, songs
+
+def baseline_x_fuzzily_contains_y(x, y):
+    """
+        x_fuzzily_contains_y as it was before the normalization layer: everything is recomputed on every call.
+    """
+    if y is None or x is None:
+        return False
+    xx = x.lower().replace('&amp;', '&').replace('&#39;',"'").replace('&quot;','"')
+    yys = [ item for item in re.split('[\\W_]+', y.lower().replace('&amp;', '&').replace('&#39;', "'").replace('&quot;', '"')) if item != '' ]
+    return all([yy in xx for yy in yys])
+
+def baseline_tags_contain_info(infos, song_info):
+    found = []
+    for mfi in infos:
+        if mfi.is_tag_set():
+            if baseline_x_fuzzily_contains_y(mfi.tag.title, song_info.title):
+                if (not mfi.tag.artist) or (not song_info.artist) or baseline_x_fuzzily_contains_y(mfi.tag.artist, song_info.artist):
+                    if (not mfi.tag.album) or (not song_info.artist) or baseline_x_fuzzily_contains_y(mfi.tag.album, song_info.album):
+                        found.append(mfi)
+    return found
+
+def per_song_ms(function, songs):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for song in songs:
+            function(song)
+    return 1000 * (time.perf_counter() - start) / len(songs)
+
+def bench_matching_normalization(num_files=20000):
+    infos, songs = synthetic_library(num_files)
+    print("Per-song cost of tags_contain_info on {} files:".format(num_files))
+    print("\tbefore (normalizing on every call): {:8.3f} ms".format(per_song_ms(lambda song: baseline_tags_contain_info(infos, song), songs)))
+    for info in infos:
+        info.get_normalized() # done once at index time
+    print("\tnormalized forms stored:            {:8.3f} ms".format(per_song_ms(lambda song: tags_contain_info(infos, song, MatchTracker(), None), songs)))
+    contains_index = ContainsIndex(infos)
+    print("\twith ContainsIndex:                 {:8.3f} ms".format(per_song_ms(lambda song: tags_contain_info(infos, song, MatchTracker(), None, contains_index=contains_index), songs)))
+
+def bench_fuzzy_matcher(num_candidates=50000, num_queries=10):
+    infos, songs = synthetic_library(num_candidates)
+    filenames = [info.filename for info in infos]
+    queries = ["{} - {}".format(song.title, song.artist) for song in songs[:num_queries]]
+    print("Per-query cost of find_match on {} file names:".format(num_candidates))
+    start = time.perf_counter()
+    expected = [find_match(query, filenames) for query in queries]
+    difflib_ms = 1000 * (time.perf_counter() - start) / num_queries
+    print("\tdifflib.get_close_matches: {:8.1f} ms".format(difflib_ms))
+    for method in ("exact", "trigram"):
+        engine = SimilarityEngine(filenames, method=method)
+        start = time.perf_counter()
+        found = [find_match(query, None, engine=engine) for query in queries]
+        ms = 1000 * (time.perf_counter() - start) / num_queries
+        same = sum(a == b for a, b in zip(found, expected))
+        print("\t{:25s}: {:8.1f} ms ({:.0f}x faster, {} of {} same as difflib)".format(method, ms, difflib_ms / ms, same, num_queries))
+
+def bench_substring_tag_match(num_files=20000):
+    infos, songs = synthetic_library(num_files)
+    print("Per-song cost of find_substring_tag_match on {} fallback files:".format(num_files))
+    print("\tlinear scan:          {:8.3f} ms".format(per_song_ms(lambda song: find_substring_tag_match(infos, song, MatchTracker(), None), songs)))
+    fallback_index = FallbackIndex(["/music"], [infos])
+    start = time.perf_counter()
+    fallback_index.build_lookups()
+    print("\tbuilding FallbackIndex: {:6.0f} ms".format(1000 * (time.perf_counter() - start)))
+    print("\twith FallbackIndex:   {:8.3f} ms".format(per_song_ms(lambda song: find_substring_tag_match(infos, song, MatchTracker(), None, fallback_index=fallback_index), songs)))
+
+def allocated_kib(build):
+    """
+        Returns what build() returned and how much memory it still holds afterwards.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    built = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return built, (after - before) / 1024
+
+def bench_library_end_to_end(num_files=50000, num_songs=20):
+    infos, songs = synthetic_library(num_files)
+    rows = [(info.full_path, info.tag.artist, info.tag.album, info.tag.title) for info in infos]
+    del infos
+    songs = songs[:num_songs]
+    # Walking and reading the tags creates new strings for every file, even if they are equal to those of other files
+    fresh = lambda string: (string + " ")[:-1]
+    audio_info = lambda: AudioInfo(bitrate=320000, length=180.0, codec=fresh("mp3"), sample_rate=44100)
+    def file_infos():
+        return [FileInfo(full_path=fresh(path), filename=os.path.basename(path), tag=FileTag(artist=fresh(artist), album=fresh(album), title=fresh(title)), audio_info=audio_info())
+                for path, artist, album, title in rows]
+    def library_index():
+        library = LibraryIndex()
+        for path, artist, album, title in rows:
+            library.append(fresh(path), tag=FileTag(artist=fresh(artist), album=fresh(album), title=fresh(title)), audio_info=audio_info())
+        return library
+    def match_context(build):
+        with contextlib.redirect_stdout(io.StringIO()):
+            library = build()
+            return library, build_match_context(library, [])
+    print("{} files with tags and audio info, through build_match_context:".format(num_files))
+    for name, build in (("list of FileInfos", file_infos), ("LibraryIndex", library_index)):
+        start = time.perf_counter()
+        _library, context = match_context(build)
+        build_s = time.perf_counter() - start
+        song_ms = per_song_ms(lambda song: resolve_song(song, context), songs)
+        del _library, context
+        _built, kib = allocated_kib(lambda: match_context(build))
+        del _built
+        print("\t{:18s}: {:8.0f} KiB held, {:5.1f} s to build, {:6.1f} ms per song".format(name, kib, build_s, song_ms))
+
+if __name__ == '__main__':
+    bench_matching_normalization()
+    bench_fuzzy_matcher()
+    bench_substring_tag_match()
+    bench_library_end_to_end()
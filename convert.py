@@ -16,19 +16,30 @@
 
 # `python convert.py -c "from convert import *; lmfi=debug_create_lmfi_sans_tags(); compute_redundant_files(lmfi);"`
 #  Computes which files are duplicates in your MUSIC_PATH and if the settings are set accordingly, dumps the computed also to a json file for your viewing pleasure.
-import os, sys, csv
-from dataclasses import dataclass
+import os, sys, csv, io
+from dataclasses import dataclass, field
 import re, difflib, sys, glob
 from pprint import pprint, pformat
 from mutagen.easyid3 import EasyID3
 from mutagen.id3 import ID3NoHeaderError
 from enum import Enum
-import mutagen
+import mutagen, mutagen.mp3
 from datetime import datetime
 import html
 import json
 import shutil, filecmp
 import hashlib
+import functools
+import collections
+import heapq
+import sqlite3
+import mmap
+import array
+import concurrent.futures
+import multiprocessing
+import subprocess
+import itertools
+import threading
 
 DEBUG_LINUX=(os.name=='posix')and False # I advise you just ignore this
 USE_UNRELIABLE_METHODS = False # Do you prefer wrong matches over missing matches that require manual adjustment?
@@ -40,6 +51,8 @@ OUTPUT_PLAYLIST_DIR_RELATIVE=os.path.normpath('N:\Files\Musik\playlists_relative
 IGNORE_MUSIC_FOLDERS=['@eaDir', os.path.basename(OUTPUT_PLAYLIST_DIR_RELATIVE)]
 MAKE_PLAYLISTS_RELATIVE_TO_OUTPUT_PLAYLIST_DIR=True
 SAVE_ABSOLUTE_PLAYLISTS=True # No harm done in always keeping this True
+EXTENDED_M3U=False # Write #EXTINF lines with the duration, artist and title of each song, so that players don't need to read the files
+USE_WRITTEN_PLAYLIST_STORE=True # Tell unchanged playlists from the stored hash of what was written, instead of reading the files again
 REDUCE_PLAYLIST_REDUNDANCIES=True
 DUMP_REDUNDANCIES_AS_JSON_TO_OUTPUT_PLAYLIST_DIR=True
 # setting this to True only makes sense with REDUCE_PLAYLIST_REDUNDANCIES.
@@ -53,6 +66,8 @@ PLAYLISTS_PATH = os.path.normpath('N:\Files\Backups\GPM_export\Takeout\Google Pl
 if DEBUG_LINUX:
     print("WARNING: Debug flag is set to true!", file=sys.stderr)
     PLAYLISTS_PATH = os.path.normpath('./Google Play Music/Playlists')
+TAKEOUT_READ_WORKERS=8 # How many of the small csv files in the Takeout are read at the same time
+USE_TAKEOUT_STORE=True # Read the Takeout only once and afterwards from the cache database. `python convert.py ingest` reads it again.
 
 # Path to where the local music resides. This will be recursively indexed using os.walk
 # No idea if that follows symlinks.
@@ -69,12 +84,54 @@ GPM_FALLBACK_TRACK_PATHS = [
         os.path.normpath('N:\Files\Backups\GPM_export\Takeout\Google Play Music\Tracks'),
         os.path.normpath('F:\PlayMusic'),
         ]
+FALLBACK_INDEX_WORKERS=4 # How many of the GPM_FALLBACK_TRACK_PATHS are walked at the same time
 
 # For de-duplication of the music library
 # Set this to true only if you are willing to wait a long time for the script to run.
 # Also, not well tested.
 I_AM_SCARED_OF_HASH_COLLISIONS=False
 
+# Caches that survive between runs, so that a rerun only needs to look at what changed.
+# The cache database lives in the OUTPUT_PLAYLIST_DIR. Delete it or set the REBUILD flags if you don't trust it.
+CACHE_DB_PATH=os.path.join(OUTPUT_PLAYLIST_DIR, "_cache.sqlite3")
+USE_DIRECTORY_INDEX=True # Only list the folders again whose modification time changed
+COMPACT_LIBRARY_INDEX=True # Keep the lists of local and fallback files in LibraryIndex arrays instead of one FileInfo per file
+REBUILD_DIRECTORY_INDEX=False
+USE_TAG_CACHE=True
+REBUILD_TAG_CACHE=False # Set to True to parse all files again and overwrite the cached tags
+
+# Reading tags mostly waits for the disk, so several files are read at once.
+TAG_INDEX_WORKERS=8 # 1 reads the files one after another
+TAG_INDEX_USE_PROCESSES=False # Threads are enough for network drives. Processes help if parsing is the bottleneck.
+NORMALIZATION_CACHE_SIZE=1<<16 # How many normalized strings are remembered while matching
+# How the USE_UNRELIABLE_METHODS find similar names: "exact" gives the same results as "difflib", just faster.
+# "trigram" is much faster, but only looks at the FUZZY_PREFILTER_SIZE names sharing the most trigrams with the song.
+FUZZY_MATCH_METHOD="exact"
+FUZZY_PREFILTER_SIZE=200
+CACHE_MATCHES_ACROSS_PLAYLISTS=True # Match a song only once, even if it is in many playlists
+USE_MATCH_STORE=True # Remember matches between runs, so that only new songs need to be matched
+REBUILD_MATCH_STORE=False # Set to True to match all songs again, e.g. after adding music or changing USE_UNRELIABLE_METHODS
+MATCH_WORKERS=4 # How many processes match songs at the same time. Only used where processes can be forked, i.e. not on Windows.
+
+USE_HASH_STORE=True # Remember file hashes for REDUCE_PLAYLIST_REDUNDANCIES, so unchanged files are not hashed again
+# Only fully hash files if another file has the same size and the same first and last few KiB. Set to False to hash everything.
+DEDUP_TIERED=True
+DEDUP_PARTIAL_HASH_KIB=64
+# Any algorithm of python's hashlib works. blake2b is faster than md5 on 64 bit machines.
+HASH_ALGORITHM="blake2b"
+HASH_WORKERS=4 # How many files are hashed at the same time
+# Set to True to only hash the audio data and skip ID3, APE and FLAC tags, so that copies with different tags count as redundant too
+HASH_AUDIO_ONLY=False
+# Which of the redundant files is kept: lossless before lossy, then higher bitrate, longer, not within these folders, more complete tags, shorter path.
+DEDUP_AVOID_FOLDERS=[COPY_FALLBACKS_TO_PATH]
+# Also find the same song in different files, e.g. a 128 kbps copy from GPM and a FLAC rip, by comparing acoustic fingerprints.
+# Needs fpcalc from https://acoustid.org/chromaprint. The fingerprints are computed locally and stored in the CACHE_DB_PATH.
+DEDUP_FINGERPRINTS=False
+FPCALC_PATH="fpcalc"
+FINGERPRINT_SECONDS=120 # How much of the beginning of every file is fingerprinted
+FINGERPRINT_MIN_SIMILARITY=0.85 # Share of equal fingerprint bits for two files to count as the same song
+DELETE_NEAR_DUPLICATES=False # Set to True to also delete files that are only the same song, not the same data
+
 class MatchSource(Enum):
     EXACT_TAG_MATCH = 1
     FUZZY = 2
@@ -83,6 +140,7 @@ class MatchSource(Enum):
     TAGS_CONTAIN = 5
     PATH_CONTAINS = 6
     SUBSTRING_TAG_MATCH = 7
+    USER_SPECIFIED = 8
 
 @dataclass()
 class Playlist:
@@ -172,7 +230,6 @@ class MatchTracker:
 def print_todos(f=sys.stderr):
     print("\n--- TODOS ---", file=f)
     print("\t Check for surprising cases with more than two rows in a song csv. (In my 4000 test cases this never occurred)", file=f)
-    print("\t Implement caching of file matches across playlists?", file=f)
     print("\t Find duplicate files in music library and suggest deletion of all but the best one.", file=f)
 
 def filter_playlists(subfolders):
@@ -192,6 +249,32 @@ def filter_playlists(subfolders):
         if valid:
             yield(folder)
 
+# --- Normalization of strings for matching ---
+# The same strings are normalized over and over again while matching, so the regexes are compiled once,
+# song-side strings go through a bounded cache and library-side forms are stored on the FileInfo.
+FUZZY_SPLIT_RE = re.compile('[\W_]+') # split on non-word characters of any amount, or underscore, or dash (included in non-word characters)
+STRIP_TITLE_RES = [re.compile('\d\d\d\d\d+'), re.compile('.mp3'), re.compile('.flac')]
+
+@functools.lru_cache(maxsize=NORMALIZATION_CACHE_SIZE)
+def unescape(text):
+    return html.unescape(text)
+
+@functools.lru_cache(maxsize=NORMALIZATION_CACHE_SIZE)
+def fuzzy_normalize(x:str):
+    return x.lower().replace('&amp;', '&').replace('&#39;',"'").replace('&quot;','"')
+
+@functools.lru_cache(maxsize=NORMALIZATION_CACHE_SIZE)
+def fuzzy_tokens(y:str):
+    return tuple( item for item in FUZZY_SPLIT_RE.split(fuzzy_normalize(y)) if item != '' )
+
+def fuzzily_contains(xx:str, yys):
+    """
+        x_fuzzily_contains_y for an already normalized x and already split y. None means the string was None.
+    """
+    if xx is None or yys is None:
+        return False
+    return all(yy in xx for yy in yys)
+
 @dataclass(frozen=True)
 class SongInfo:
     """
@@ -202,79 +285,228 @@ class SongInfo:
     liked: bool
     album: str
     title_stripped: str
+    # normalized forms for matching. Not part of equality or repr, so they don't change keys in _missing_matches.json
+    title_tokens: tuple = field(default=None, init=False, repr=False, compare=False)
+    artist_tokens: tuple = field(default=None, init=False, repr=False, compare=False)
+    album_tokens: tuple = field(default=None, init=False, repr=False, compare=False)
+    fuzzy_tag_key: str = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # frozen, so the fields have to be set this way
+        object.__setattr__(self, 'title_tokens', None if self.title is None else fuzzy_tokens(self.title))
+        object.__setattr__(self, 'artist_tokens', None if self.artist is None else fuzzy_tokens(self.artist))
+        object.__setattr__(self, 'album_tokens', None if self.album is None else fuzzy_tokens(self.album))
+        object.__setattr__(self, 'fuzzy_tag_key', "{}{}".format(self.title, self.artist))
+
+    def with_swapped_titles(self):
+        """
+            Returns the same song with title and title_stripped swapped, for trying to match the stripped title.
+        """
+        return SongInfo(title=self.title_stripped, artist=self.artist, album=self.album, title_stripped=self.title, liked=self.liked)
 
 def strip_title(title):
     if title is None:
         return ""
-    t = re.sub('\d\d\d\d\d+', '', title)
-    t = re.sub('.mp3', '', t)
-    t = re.sub('.flac', '', t)
+    t = title
+    for regex in STRIP_TITLE_RES:
+        t = regex.sub('', t)
     return t
 
-def read_gpm_playlist(playlistdir, trackdir='Tracks'):
+def list_gpm_track_csvs(playlistdir, trackdir='Tracks'):
     """
-      Returns a list of song names contained in a GPM Takeout Playlist
+      Returns the paths of the track csv files of a GPM Takeout Playlist
+    """
+    return [ f.path for f in os.scandir(os.path.join(playlistdir, trackdir)) if f.is_file() ]
+
+def read_small_files(paths):
+    contents = []
+    for path in paths:
+        with open(path, "rb") as f:
+            contents.append(f.read())
+    return contents
+
+def gpm_playlist_index_key(playlist_index):
+    # numeric, so that "10" comes after "2". Anything that is not a number comes last.
+    try:
+        return (0, int(playlist_index), "")
+    except ValueError:
+        return (1, 0, playlist_index)
+
+def parse_gpm_track_csv(data: bytes, song_csv):
     """
-    song_infos_unsorted = []
-    tracks_path = os.path.join(playlistdir, trackdir)
-    # Expected contents of that directory is one file per song, 
-    # each file csv-formatted and containing something like this:
+      Returns a list of (playlist_index, SongInfo) for the content of one track csv file
+    """
+    # Expected content is something like this:
     # 
     # Title,Album,Artist,Duration (ms),Rating,Play Count,Removed,Playlist Index
     # "The Show","Lenka","Lenka","235728","5","24","","4"
     # <newline>
-    
-    song_csvs = [ f.path for f in os.scandir(tracks_path) if f.is_file() ]
-    for song_csv in song_csvs:
-        try:
-            with open(song_csv, encoding="utf-8") as csvfile:
-                rows = csv.reader(csvfile)
-                for title, album, artist, duration_ms, rating, play_count, removed, playlist_index in rows:
-                    if (title.strip() == 'Title') and (artist.strip() == 'Artist') and (album.strip() == 'Album'):
-                        # skip headline
-                        continue
-                    # clean up google's htmlencoding mess
-                    title = html.unescape(title)
-                    album = html.unescape(album)
-                    artist = html.unescape(artist)
-
-                    print("Reading GPM  {} by {}.".format(title, artist))
-                    song_info = SongInfo(title= title, album= album, artist= artist, liked= (rating == '5'),
-                            title_stripped=strip_title(title))
-                    song_infos_unsorted.append((song_info, playlist_index))
-        except UnicodeEncodeError as e:
-            print("INFO: Skipping file {} due to Unicode Reading Error.".format(song_csv))
-
-    # sort playlist by index
-    song_infos_sorted = sorted(song_infos_unsorted, key=lambda x: x[1])
-    return [song_tuple[0] for song_tuple in song_infos_sorted]
+    try:
+        text = data.decode("utf-8")
+    except UnicodeError:
+        print("INFO: Skipping file {} due to Unicode Reading Error.".format(song_csv))
+        return []
+    song_infos = []
+    for title, album, artist, duration_ms, rating, play_count, removed, playlist_index in csv.reader(io.StringIO(text)):
+        if (title.strip() == 'Title') and (artist.strip() == 'Artist') and (album.strip() == 'Album'):
+            # skip headline
+            continue
+        # clean up google's htmlencoding mess
+        title = unescape(title)
+        album = unescape(album)
+        artist = unescape(artist)
+
+        song_info = SongInfo(title= title, album= album, artist= artist, liked= (rating == '5'),
+                title_stripped=strip_title(title))
+        song_infos.append((playlist_index, song_info))
+    return song_infos
+
+def read_gpm_songlists(playlists, workers=TAKEOUT_READ_WORKERS, batch_size=256):
+    """
+      playlists is a list of (playlist name, track csv paths), e.g. from list_gpm_track_csvs.
+      Yields (playlist name, list of SongInfo sorted by playlist index) for each playlist, in the same order.
+      One file per song takes much longer to open than to parse, so the files of all playlists are read in batches by one pool of threads.
+    """
+    all_song_csvs = [song_csv for _name, song_csvs in playlists for song_csv in song_csvs]
+    batches = [all_song_csvs[i:i+batch_size] for i in range(0, len(all_song_csvs), batch_size)]
+    contents = (data for batch in map_with_workers(read_small_files, batches, workers=workers) for data in batch)
+    for name, song_csvs in playlists:
+        song_infos_unsorted = []
+        for song_csv, data in zip(song_csvs, contents):
+            song_infos_unsorted.extend(parse_gpm_track_csv(data, song_csv))
+        # sort playlist by index
+        song_infos_unsorted.sort(key=lambda x: gpm_playlist_index_key(x[0]))
+        yield name, [song_tuple[1] for song_tuple in song_infos_unsorted]
+
+def read_gpm_playlist(playlistdir, trackdir='Tracks'):
+    """
+      Returns a list of song names contained in a GPM Takeout Playlist
+    """
+    return next(read_gpm_songlists([(trackdir, list_gpm_track_csvs(playlistdir, trackdir))]))[1]
+
+def list_takeout_playlists(mdir=PLAYLISTS_PATH):
+    """
+      Returns a list of (playlist name, playlistdir, trackdir) for all playlists in the Takeout, with Thumbs up last.
+    """
+    subfolders = [ f.path for f in os.scandir(mdir) if f.is_dir() and not is_ignored(f.path) ]
+    takeout_playlists = [(os.path.basename(os.path.normpath(playlistpath)), playlistpath, 'Tracks') for playlistpath in filter_playlists(subfolders)]
+    # the Thumbs up Playlist is not a valid playlist folder, so it is added separately
+    if os.path.isdir(os.path.join(mdir, 'Thumbs up')):
+        takeout_playlists.append(('Thumbs up', mdir, 'Thumbs up'))
+    return takeout_playlists
+
+def scan_takeout_track_csvs(takeout_playlists):
+    """
+      Returns a list of (playlist name, list of (track csv path, size, mtime_ns)) for the output of list_takeout_playlists.
+    """
+    scanned = []
+    for name, playlistdir, trackdir in takeout_playlists:
+        csvs = []
+        for f in os.scandir(os.path.join(playlistdir, trackdir)):
+            if f.is_file():
+                st = f.stat()
+                csvs.append((f.path, st.st_size, st.st_mtime_ns))
+        scanned.append((name, csvs))
+    return scanned
+
+def takeout_fingerprint(mdir, track_csvs):
+    """
+      Changes whenever a track csv file is added, removed, renamed or rewritten, e.g. by extracting a new export over the old one.
+      track_csvs is the output of scan_takeout_track_csvs.
+    """
+    h = hashlib.blake2b(os.path.abspath(mdir).encode("utf-8"))
+    for name, csvs in track_csvs:
+        h.update("{}\0".format(name).encode("utf-8"))
+        for path, size, mtime_ns in sorted(csvs):
+            h.update("{}\0{}\0{}\0".format(os.path.basename(path), size, mtime_ns).encode("utf-8"))
+    return h.hexdigest()
+
+class TakeoutStore:
+    """
+        The songs of all playlists of a Takeout, stored in the cache database together with the fingerprint of the Takeout.
+        Loading them is one sequential read instead of opening one csv file per song.
+    """
+    def __init__(self, db_path=CACHE_DB_PATH):
+        self.db = open_cache_db(db_path)
+        ensure_cache_table(self.db, "takeout_info", ["key TEXT PRIMARY KEY", "value TEXT"])
+        ensure_cache_table(self.db, "takeout_playlists", ["position INTEGER PRIMARY KEY", "name TEXT"])
+        ensure_cache_table(self.db, "takeout_songs", ["playlist INTEGER", "position INTEGER", "title TEXT", "album TEXT", "artist TEXT", "liked INTEGER", "title_stripped TEXT", "PRIMARY KEY (playlist, position)"])
+
+    def load(self, fingerprint):
+        """
+            Returns the stored list of (playlist name, list of SongInfo), or None if they were stored for a different fingerprint.
+        """
+        row = self.db.execute("SELECT value FROM takeout_info WHERE key = 'fingerprint'").fetchone()
+        if row is None or row[0] != fingerprint:
+            return None
+        songlists = [(name, []) for (name,) in self.db.execute("SELECT name FROM takeout_playlists ORDER BY position")]
+        for playlist, title, album, artist, liked, title_stripped in self.db.execute("SELECT playlist, title, album, artist, liked, title_stripped FROM takeout_songs ORDER BY playlist, position"):
+            songlists[playlist][1].append(SongInfo(title=title, album=album, artist=artist, liked=bool(liked), title_stripped=title_stripped))
+        return songlists
+
+    def save(self, songlists, fingerprint):
+        self.db.execute("DELETE FROM takeout_playlists")
+        self.db.execute("DELETE FROM takeout_songs")
+        self.db.executemany("INSERT INTO takeout_playlists VALUES (?, ?)", enumerate(name for name, _song_infos in songlists))
+        self.db.executemany("INSERT INTO takeout_songs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((playlist, position, s.title, s.album, s.artist, s.liked, s.title_stripped)
+                    for playlist, (_name, song_infos) in enumerate(songlists) for position, s in enumerate(song_infos)))
+        self.db.execute("INSERT OR REPLACE INTO takeout_info VALUES ('fingerprint', ?)", (fingerprint,))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+def read_takeout(mdir=PLAYLISTS_PATH, use_store=USE_TAKEOUT_STORE, reingest=False, db_path=CACHE_DB_PATH, workers=TAKEOUT_READ_WORKERS):
+    """
+      Returns a list of (playlist name, list of SongInfo sorted by playlist index) for all playlists in the Takeout, with Thumbs up last.
+      With use_store, the Takeout is only read if the TakeoutStore does not have it yet (or reingest is set), and then stored.
+    """
+    track_csvs = scan_takeout_track_csvs(list_takeout_playlists(mdir))
+    read_all = lambda: list(read_gpm_songlists([(name, [path for path, _size, _mtime_ns in csvs]) for name, csvs in track_csvs], workers=workers))
+    if not use_store:
+        return read_all()
+    fingerprint = takeout_fingerprint(mdir, track_csvs)
+    store = TakeoutStore(db_path)
+    try:
+        songlists = None if reingest else store.load(fingerprint)
+        if songlists is None:
+            print("Ingesting the Takeout playlists...")
+            songlists = read_all()
+            store.save(songlists, fingerprint)
+        else:
+            print("Loaded the Takeout playlists from {}".format(db_path))
+        return songlists
+    finally:
+        store.close()
+
+def ingest_takeout(mdir=PLAYLISTS_PATH, db_path=CACHE_DB_PATH):
+    """
+      Reads the whole Takeout into the TakeoutStore, even if it is already stored.
+    """
+    songlists = read_takeout(mdir, use_store=True, reingest=True, db_path=db_path)
+    print("Ingested {} songs in {} playlists.".format(sum(len(song_infos) for _name, song_infos in songlists), len(songlists)))
 
 def generate_songlists(mdir=PLAYLISTS_PATH, outdir='./songlists', handle_thumbs_up=HANDLE_THUMBS_UP):
-    subfolders = [ f.path for f in os.scandir(mdir) if f.is_dir() ]
-    playlists = list(filter_playlists(subfolders))
     os.makedirs(os.path.normpath(outdir), exist_ok=True)
-    for playlistpath in playlists:
-        song_info_list_sorted = read_gpm_playlist(playlistpath)
-        playlistname = os.path.basename(os.path.normpath(playlistpath))
+    for playlistname, song_info_list_sorted in read_takeout(mdir):
+        # now handle the Thumbs up playlist
+        if playlistname == 'Thumbs up' and not handle_thumbs_up:
+            continue
         playlistpath = os.path.join(outdir, playlistname)
         with open("{}.txt".format(playlistpath), 'w+', encoding="utf-8") as sfile:
             for info in song_info_list_sorted:
                 sfile.write("{artist} - {title} - {album}\n".format(artist=info.artist, title=info.title, album=info.album))
-    # now handle the Thumbs up playlist
-    if handle_thumbs_up:
-        sils = read_gpm_playlist(mdir, trackdir='Thumbs up')
-        playlistname='Thumbs up'
-        playlistpath = os.path.join(outdir, playlistname)
-        with open("{}.txt".format(playlistpath), 'w+', encoding="utf-8") as sfile:
-            for info in sils:
-                sfile.write("{artist} - {title} - {album}\n".format(artist=info.artist, title=info.title, album=info.album))
 
 
 
-def find_match(trackname, possible_names, cutoff=0.3):
+def find_match(trackname, possible_names, cutoff=0.3, engine=None):
     """
       Return None if no good match found, otherwise return the possible_names[i] that matched well.
+      If a SimilarityEngine built from the possible_names is given, it is used instead of difflib.
     """
+    if engine is not None:
+        return engine.best_match(trackname, cutoff=cutoff)
     # inspired by rhasselbaum's https://gist.github.com/rhasselbaum/e1cf714e21f00741826f
     # we're asking for exactly one match and set the cutoff quite high - i.e. the match must be good.
     close_matches = difflib.get_close_matches(trackname, possible_names, n=1, cutoff=cutoff)
@@ -282,7 +514,118 @@ def find_match(trackname, possible_names, cutoff=0.3):
         return close_matches[0]
     else:
         return None
-    
+
+def difflib_ratio(matches, length):
+    # exactly like difflib computes its ratios, so that comparisons with the cutoff give the same results
+    if length:
+        return 2.0 * matches / length
+    return 1.0
+
+class SimilarityEngine:
+    """
+        Built once from the possibilities, then finds the best match like difflib.get_close_matches(query, possibilities, n=1, cutoff).
+
+        Methods:
+        "difflib": just calls difflib.
+        "exact": same result as difflib. real_quick_ratio and quick_ratio are upper bounds of ratio, so candidates are
+                 checked in order of their quick_ratio and the expensive ratio stops once no candidate can beat the best one.
+        "trigram": only the prefilter_size possibilities sharing the most trigrams with the query are checked with ratio.
+                 Much faster, and a found match still has a ratio >= cutoff, but it can miss the best match.
+    """
+    METHODS = ("difflib", "exact", "trigram")
+
+    def __init__(self, possibilities, values=None, method=FUZZY_MATCH_METHOD, prefilter_size=FUZZY_PREFILTER_SIZE):
+        if method not in SimilarityEngine.METHODS:
+            raise ValueError("Unknown similarity method {}. Use one of {}".format(method, SimilarityEngine.METHODS))
+        self.method = method
+        self.prefilter_size = prefilter_size
+        self.first_values = {} # maps each unique possibility to the value of its first occurrence
+        for i, possibility in enumerate(possibilities):
+            if possibility not in self.first_values:
+                self.first_values[possibility] = possibility if values is None else values[i]
+        self.possibilities = list(self.first_values)
+        if method == "exact":
+            # maps (character, k) to the positions of the possibilities containing the character at least k times,
+            # so that the matches counted by quick_ratio can be summed up by Counter.update instead of a python loop
+            self.character_postings = {}
+            for position, possibility in enumerate(self.possibilities):
+                for character, count in collections.Counter(possibility).items():
+                    for k in range(1, count + 1):
+                        posting = self.character_postings.get((character, k))
+                        if posting is None:
+                            posting = self.character_postings[(character, k)] = array.array('I')
+                        posting.append(position)
+        if method == "trigram":
+            self.trigrams = NgramIndex(self.possibilities, enough_candidates=0)
+
+    def value_of(self, possibility):
+        return self.first_values[possibility]
+
+    def best_match(self, query, cutoff=0.3):
+        """
+            Returns the possibility with the highest ratio >= cutoff, or None. Ties go to the larger string, like in difflib.
+        """
+        if self.method == "difflib":
+            close_matches = difflib.get_close_matches(query, self.possibilities, n=1, cutoff=cutoff)
+            return close_matches[0] if close_matches else None
+        if self.method == "exact":
+            candidates = self.quick_ratio_candidates(query, cutoff)
+        else:
+            candidates = self.trigram_candidates(query)
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(query)
+        best = None # (ratio, possibility)
+        for bound, possibility in candidates:
+            if best is not None and bound < best[0]:
+                break
+            matcher.set_seq1(possibility)
+            ratio = matcher.ratio()
+            if ratio >= cutoff and (best is None or (ratio, possibility) > best):
+                best = (ratio, possibility)
+        return None if best is None else best[1]
+
+    def quick_ratio_candidates(self, query, cutoff):
+        """
+            (quick_ratio, possibility) of all possibilities that pass the cheap checks of difflib, best bound first.
+            quick_ratio is never larger than real_quick_ratio, so the latter doesn't need to be checked.
+        """
+        lb = len(query)
+        matches = collections.Counter()
+        for character, count in collections.Counter(query).items():
+            for k in range(1, count + 1):
+                posting = self.character_postings.get((character, k))
+                if posting is None:
+                    break
+                matches.update(posting)
+        if cutoff <= 0:
+            # possibilities without any common character pass as well
+            for position in range(len(self.possibilities)):
+                matches[position] += 0
+        elif lb == 0 and '' in self.first_values:
+            # two empty strings are equal
+            matches[self.possibilities.index('')] += 0
+        candidates = []
+        for position, m in matches.items():
+            possibility = self.possibilities[position]
+            bound = difflib_ratio(m, len(possibility) + lb)
+            if bound >= cutoff:
+                # negated for the min-heap
+                candidates.append((-bound, possibility))
+        heapq.heapify(candidates)
+        while candidates:
+            negative_bound, possibility = heapq.heappop(candidates)
+            yield (-negative_bound, possibility)
+
+    def trigram_candidates(self, query):
+        """
+            The possibilities sharing the most trigrams with the query. They are all checked, so the bound is 1.0
+        """
+        shared = collections.Counter()
+        n = self.trigrams.n
+        for gram in { query[i:i+n] for i in range(len(query) - n + 1) }:
+            shared.update(self.trigrams.postings.get(gram, ()))
+        return [(1.0, self.possibilities[position]) for position, _count in shared.most_common(self.prefilter_size)]
+
 @dataclass
 class FileTag:
     artist: str
@@ -309,43 +652,649 @@ class FileTag:
             result = result and (self.album == album)
         return result
 
+@dataclass(frozen=True)
+class NormalizedFileInfo:
+    """
+        The forms of a FileInfo's strings that the matchers compare against. Parts of unset tags are None.
+    """
+    path: str
+    title: str
+    artist: str
+    album: str
+    fuzzy_tag_key: str
+
+# Files that are certainly audio files, or certainly not. Files with other extensions are recognized by their first bytes.
+AUDIO_FILE_EXTENSIONS = {'.mp3', '.mp2', '.flac', '.ogg', '.oga', '.opus', '.spx', '.m4a', '.m4b', '.mp4', '.aac', '.wma', '.asf',
+        '.wav', '.aif', '.aiff', '.ape', '.wv', '.mpc', '.tta', '.dsf', '.dff'}
+NON_AUDIO_FILE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.txt', '.nfo', '.log', '.cue', '.m3u', '.m3u8', '.pls',
+        '.pdf', '.db', '.ini', '.sfv', '.md5', '.json', '.xml', '.htm', '.html', '.url', '.lnk', '.sqlite3'}
+AUDIO_MAGIC_BYTES = [(0, b'ID3'), (0, b'fLaC'), (0, b'OggS'), (0, b'RIFF'), (0, b'FORM'), (4, b'ftyp'), (0, b'MAC '), (0, b'wvpk'),
+        (0, b'MPCK'), (0, b'MP+'), (0, b'TTA1'), (0, b'DSD '), (0, b'\x30\x26\xb2\x75\x8e\x66\xcf\x11')]
+
+def looks_like_audio_file(path):
+    """
+        Cheap check whether mutagen could find tags in the file: by extension, or else by the first few bytes.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in AUDIO_FILE_EXTENSIONS:
+        return True
+    if extension in NON_AUDIO_FILE_EXTENSIONS:
+        return False
+    try:
+        with open(path, "rb") as f:
+            head = f.read(12)
+    except OSError:
+        return False
+    if len(head) >= 2 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0:
+        return True # MPEG frame without ID3 tag
+    return any(head[offset:offset+len(magic)] == magic for offset, magic in AUDIO_MAGIC_BYTES)
+
+# FileInfo.tag before it was read from the file
+TAG_NOT_LOADED = object()
+
+@dataclass(frozen=True)
+class AudioInfo:
+    """
+        Stream info of an audio file, read together with its tag. Unknown parts are 0 or "".
+    """
+    bitrate: int # bits per second
+    length: float # seconds
+    codec: str
+    sample_rate: int
+
+    @staticmethod
+    def of(mutagen_info, codec):
+        return AudioInfo(bitrate=getattr(mutagen_info, 'bitrate', 0) or 0, length=getattr(mutagen_info, 'length', 0.0) or 0.0,
+                codec=codec, sample_rate=getattr(mutagen_info, 'sample_rate', 0) or 0)
+
+# AudioInfo of files that are not audio files or could not be read
+UNKNOWN_AUDIO_INFO = AudioInfo(bitrate=0, length=0.0, codec="", sample_rate=0)
+
 @dataclass
 class FileInfo:
     full_path: str
     filename: str
-    tag: FileTag = None
+    audio_info: AudioInfo = field(default=None, repr=False, compare=False) # set when the tag is read
+    # read from the file on first access of FileInfo.tag
+    _tag: FileTag = field(default=TAG_NOT_LOADED, init=False, repr=False, compare=False)
+    # (tag, full_path, NormalizedFileInfo) as computed by get_normalized
+    normalized_cache: tuple = field(default=None, init=False, repr=False, compare=False)
+
+    # Written by hand so that the tag can be given here, but is only read from the file when it is needed
+    def __init__(self, full_path: str, filename: str, tag: FileTag = TAG_NOT_LOADED, audio_info: AudioInfo = None):
+        self.full_path = full_path
+        self.filename = filename
+        self.audio_info = audio_info
+        self._tag = tag
+        self.normalized_cache = None
+
+    # Written by hand to use the tag as it is, so that printing or comparing FileInfos does not read the files
+    def __repr__(self):
+        tag = "<not loaded>" if self._tag is TAG_NOT_LOADED else repr(self._tag)
+        return "FileInfo(full_path={!r}, filename={!r}, tag={})".format(self.full_path, self.filename, tag)
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return (self.full_path, self.filename, self._tag) == (other.full_path, other.filename, other._tag)
 
     def get_plain_filename(self):
         return os.path.splitext(self.filename)[0]
 
+    def get_normalized(self):
+        """
+            Computed once per FileInfo and stored. It is computed again if another tag object is assigned or the path changed,
+            but not if the parts of the FileTag are modified in place.
+            Library strings are mostly unique, so they don't go through the bounded cache of song-side strings.
+        """
+        cache = self.normalized_cache
+        if cache is not None and cache[0] is self.tag and cache[1] == self.full_path:
+            return cache[2]
+        normalized = normalize_file_info(self.full_path, self.tag if self.is_tag_set() else None)
+        self.normalized_cache = (self.tag, self.full_path, normalized)
+        return normalized
+
     def is_tag_set(self):
         return not (True if self.tag is None else self.tag.is_everything_unset())
 
+    def get_tag(self):
+        if self._tag is TAG_NOT_LOADED:
+            self.update_tag_from_fs()
+        return self._tag
+
+    def set_tag(self, tag):
+        self._tag = tag
+
+    tag = property(get_tag, set_tag)
+
+    def is_tag_loaded(self):
+        return self._tag is not TAG_NOT_LOADED
+
+    def get_audio_info(self):
+        """
+            Returns the AudioInfo that was read together with the tag. If the tag was not read from the file, the file is read now.
+        """
+        if self.audio_info is None:
+            self.audio_info = read_audio_info_from_fs(self.full_path)
+        return self.audio_info
+
     def update_tag_from_fs(self):
         newly_loaded_tag = False
+        self.audio_info = UNKNOWN_AUDIO_INFO
+        if not looks_like_audio_file(self.full_path):
+            # covers, playlists and the like. Not worth two attempts of mutagen.
+            self.tag = None
+            return
+        # The file is opened once for the tag and the stream info
         try:
-            # the returns from mutagen are lists, that's why the index 0 everywhere.
-            tag=EasyID3(self.full_path)
-            self.tag = FileTag(artist=(tag['artist'][0] if 'artist' in tag else ''), album=(tag['album'][0] if 'album' in tag else ''), title=(tag['title'][0] if 'title' in tag else ''))
-            newly_loaded_tag = True
-        except ID3NoHeaderError:
-            # This is not a music file or has no tags
+            f = open(self.full_path, "rb")
+        except OSError as err:
+            print("INFO: Could not open {}: {}".format(self.full_path, err))
             self.tag = None
+            return
+        with f:
             try:
-                # OOOr maybe it is a FLAC file instead of an mp3 file
-                # or anything else... let the library guess...
-                tag = mutagen.File(self.full_path)
-                if tag is not None:
-                    self.tag = FileTag(artist=(tag['artist'][0] if 'artist' in tag else ''), album=(tag['album'][0] if 'album' in tag else ''), title=(tag['title'][0] if 'title' in tag else ''))
-                    newly_loaded_tag = True
-            except mutagen.mp3.HeaderNotFoundError as err:
-                self.tag = None # happens. "can't sync to MPEG frame" is the ~800th check, so it's probably just not a music file.
+                # the returns from mutagen are lists, that's why the index 0 everywhere.
+                tag=EasyID3(f)
+                self.tag = FileTag(artist=(tag['artist'][0] if 'artist' in tag else ''), album=(tag['album'][0] if 'album' in tag else ''), title=(tag['title'][0] if 'title' in tag else ''))
+                newly_loaded_tag = True
+                # In an mp3 file, the frames start right after the ID3 tag. FLAC and other files can start with an ID3 tag too,
+                # and searching them for MPEG frames could find something that only looks like one.
+                f.seek(tag.size)
+                head = f.read(2)
+                if len(head) == 2 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0:
+                    try:
+                        info = mutagen.mp3.MPEGInfo(f, tag.size)
+                        self.audio_info = AudioInfo.of(info, "mp{}".format(info.layer))
+                    except mutagen.mp3.HeaderNotFoundError:
+                        pass
+                else:
+                    try:
+                        f.seek(0)
+                        audio = mutagen.File(f)
+                    except mutagen.MutagenError:
+                        audio = None
+                    if audio is not None:
+                        self.audio_info = AudioInfo.of(audio.info, getattr(audio.info, 'codec', None) or type(audio).__name__.lower())
+            except ID3NoHeaderError:
+                # This is not a music file or has no tags
+                self.tag = None
+                try:
+                    # OOOr maybe it is a FLAC file instead of an mp3 file
+                    # or anything else... let the library guess...
+                    f.seek(0)
+                    tag = mutagen.File(f)
+                    if tag is not None:
+                        self.tag = FileTag(artist=(tag['artist'][0] if 'artist' in tag else ''), album=(tag['album'][0] if 'album' in tag else ''), title=(tag['title'][0] if 'title' in tag else ''))
+                        self.audio_info = AudioInfo.of(tag.info, getattr(tag.info, 'codec', None) or type(tag).__name__.lower())
+                        newly_loaded_tag = True
+                except mutagen.mp3.HeaderNotFoundError as err:
+                    self.tag = None # happens. "can't sync to MPEG frame" is the ~800th check, so it's probably just not a music file.
+                except mutagen.MutagenError as err:
+                    print("INFO: Could not read the tags of {}: {}".format(self.full_path, err))
+                    self.tag = None
 
         if newly_loaded_tag:
             # Need to transform "&quot;", "&amp;" and similar because locally this is stored correctly in the tags.
-            self.tag.title = html.unescape(self.tag.title)
-            self.tag.album = html.unescape(self.tag.album)
-            self.tag.artist = html.unescape(self.tag.artist)
+            self.tag.title = unescape(self.tag.title)
+            self.tag.album = unescape(self.tag.album)
+            self.tag.artist = unescape(self.tag.artist)
+
+def normalize_file_info(full_path, tag):
+    """
+        Returns the NormalizedFileInfo of a file with the given path and tag, which is None if the tag is not set.
+    """
+    normalize = lambda x: None if x is None else fuzzy_normalize.__wrapped__(x)
+    return NormalizedFileInfo(path=normalize(full_path),
+            title=None if tag is None else normalize(tag.title),
+            artist=None if tag is None else normalize(tag.artist),
+            album=None if tag is None else normalize(tag.album),
+            fuzzy_tag_key=None if tag is None else "{}{}".format(tag.title, tag.artist))
+
+def read_audio_info_from_fs(full_path):
+    """
+        Returns the AudioInfo of the file without looking at its tag.
+    """
+    try:
+        audio = mutagen.File(full_path)
+    except mutagen.MutagenError:
+        audio = None
+    return UNKNOWN_AUDIO_INFO if audio is None else AudioInfo.of(audio.info, type(audio).__name__.lower())
+
+class StringTable:
+    """
+        Stores each distinct string once. Rows refer to a string by its number.
+    """
+    def __init__(self):
+        self.strings = []
+        self.numbers = {}
+
+    def number_of(self, string):
+        number = self.numbers.get(string)
+        if number is None:
+            number = self.numbers[string] = len(self.strings)
+            self.strings.append(string)
+        return number
+
+    def __getitem__(self, number):
+        return self.strings[number]
+
+    def __len__(self):
+        return len(self.strings)
+
+# Tag part numbers in a LibraryIndex that are not numbers of strings
+LIBRARY_TAG_NOT_LOADED = -1
+LIBRARY_NO_TAG = -2
+
+class LibraryIndex:
+    """
+        Compact storage of the files of a library, for libraries that are too large for a list of FileInfos.
+
+        There is one array per attribute with one item per file, instead of one object per file and per tag. The folders and
+        the parts of the tags repeat a lot, so they are stored once in string tables and the rows only hold their numbers.
+        Indexing or iterating returns LibraryEntry views, which the matchers can use like FileInfos. Setting the tag or the
+        audio info of a view writes it to the arrays. The indices of the MatchContext refer to the files by their position,
+        so views are only created for the files they return.
+    """
+    def __init__(self):
+        self.folders = StringTable() # everything of the path before the file name, including the separator
+        self.strings = StringTable() # tag parts and codecs
+        self.folder_numbers = array.array('i')
+        self.names = [] # file names are mostly unique, so they are not worth a table
+        self.other_filenames = {} # position: filename, for the rare FileInfos whose filename is not the last part of their path
+        self.artists = array.array('i')
+        self.albums = array.array('i')
+        self.titles = array.array('i')
+        self.bitrates = array.array('q')
+        self.lengths = array.array('d')
+        self.codecs = array.array('i') # -1 if the audio info is not known yet
+        self.sample_rates = array.array('i')
+        # normalized forms of the folders and strings, by their number. Normalizing the folder and the name of a path separately
+        # gives the same as normalizing the whole path, so each folder is only normalized once.
+        self.normalized_folders = {}
+        self.normalized_strings = {}
+
+    @staticmethod
+    def from_paths(paths):
+        library = LibraryIndex()
+        for path in paths:
+            library.append(path)
+        return library
+
+    @staticmethod
+    def from_file_infos(file_infos):
+        library = LibraryIndex()
+        library.extend(file_infos)
+        return library
+
+    def extend(self, file_infos):
+        """
+            Appends FileInfos or the files of another LibraryIndex, with their tags and audio infos if they are known.
+        """
+        if not isinstance(file_infos, LibraryIndex):
+            for file_info in file_infos:
+                self.append(file_info.full_path, filename=file_info.filename,
+                        tag=file_info.tag if file_info.is_tag_loaded() else TAG_NOT_LOADED, audio_info=file_info.audio_info)
+            return
+        # row by row, so that no views are created. Only the numbers of the folders and strings change.
+        other = file_infos
+        offset = len(self)
+        folder_number = lambda number: self.folders.number_of(other.folders[number])
+        string_number = lambda number: number if number < 0 else self.strings.number_of(other.strings[number])
+        self.folder_numbers.extend(folder_number(number) for number in other.folder_numbers)
+        self.names.extend(other.names)
+        self.other_filenames.update((offset + position, filename) for position, filename in other.other_filenames.items())
+        for column, other_column in ((self.artists, other.artists), (self.albums, other.albums), (self.titles, other.titles), (self.codecs, other.codecs)):
+            column.extend(string_number(number) for number in other_column)
+        self.bitrates.extend(other.bitrates)
+        self.lengths.extend(other.lengths)
+        self.sample_rates.extend(other.sample_rates)
+
+    def append(self, full_path, filename=None, tag=TAG_NOT_LOADED, audio_info=None):
+        name = os.path.basename(full_path)
+        position = len(self.names)
+        self.folder_numbers.append(self.folders.number_of(full_path[:len(full_path) - len(name)]))
+        self.names.append(name)
+        if filename is not None and filename != name:
+            self.other_filenames[position] = filename
+        self.artists.append(LIBRARY_TAG_NOT_LOADED)
+        self.albums.append(LIBRARY_TAG_NOT_LOADED)
+        self.titles.append(LIBRARY_TAG_NOT_LOADED)
+        self.bitrates.append(0)
+        self.lengths.append(0.0)
+        self.codecs.append(-1)
+        self.sample_rates.append(0)
+        if tag is not TAG_NOT_LOADED:
+            self.set_tag(position, tag)
+        if audio_info is not None:
+            self.set_audio_info(position, audio_info)
+
+    def full_path(self, position):
+        return self.folders[self.folder_numbers[position]] + self.names[position]
+
+    def filename(self, position):
+        return self.other_filenames.get(position, self.names[position])
+
+    def tag_numbers(self, position):
+        return (self.artists[position], self.albums[position], self.titles[position])
+
+    def get_tag(self, position):
+        """
+            Returns TAG_NOT_LOADED, None or a new FileTag.
+        """
+        artist, album, title = self.tag_numbers(position)
+        if artist == LIBRARY_TAG_NOT_LOADED:
+            return TAG_NOT_LOADED
+        if artist == LIBRARY_NO_TAG:
+            return None
+        return FileTag(artist=self.strings[artist], album=self.strings[album], title=self.strings[title])
+
+    def set_tag(self, position, tag):
+        if tag is TAG_NOT_LOADED or tag is None:
+            numbers = (LIBRARY_TAG_NOT_LOADED if tag is TAG_NOT_LOADED else LIBRARY_NO_TAG,) * 3
+        else:
+            numbers = (self.strings.number_of(tag.artist), self.strings.number_of(tag.album), self.strings.number_of(tag.title))
+        self.artists[position], self.albums[position], self.titles[position] = numbers
+
+    def normalized_string(self, number):
+        if number not in self.normalized_strings:
+            string = self.strings[number]
+            self.normalized_strings[number] = None if string is None else fuzzy_normalize.__wrapped__(string)
+        return self.normalized_strings[number]
+
+    def normalized(self, position):
+        """
+            Returns the NormalizedFileInfo of the file, like normalize_file_info. The tag must be loaded.
+        """
+        folder = self.folder_numbers[position]
+        normalized_folder = self.normalized_folders.get(folder)
+        if normalized_folder is None:
+            normalized_folder = self.normalized_folders[folder] = fuzzy_normalize.__wrapped__(self.folders[folder])
+        path = normalized_folder + fuzzy_normalize.__wrapped__(self.names[position])
+        artist, album, title = self.tag_numbers(position)
+        if artist < 0 or not (self.strings[artist] or self.strings[album] or self.strings[title]):
+            return NormalizedFileInfo(path=path, title=None, artist=None, album=None, fuzzy_tag_key=None)
+        return NormalizedFileInfo(path=path, title=self.normalized_string(title), artist=self.normalized_string(artist),
+                album=self.normalized_string(album), fuzzy_tag_key="{}{}".format(self.strings[title], self.strings[artist]))
+
+    def get_audio_info(self, position):
+        """
+            Returns the AudioInfo, or None if it is not known yet.
+        """
+        codec = self.codecs[position]
+        if codec == -1:
+            return None
+        return AudioInfo(bitrate=self.bitrates[position], length=self.lengths[position], codec=self.strings[codec], sample_rate=self.sample_rates[position])
+
+    def set_audio_info(self, position, audio_info):
+        if audio_info is None:
+            self.codecs[position] = -1
+            return
+        self.bitrates[position] = audio_info.bitrate
+        self.lengths[position] = audio_info.length
+        self.codecs[position] = self.strings.number_of(audio_info.codec)
+        self.sample_rates[position] = audio_info.sample_rate
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        return LibraryEntry(self, position)
+
+    def __iter__(self):
+        return (LibraryEntry(self, position) for position in range(len(self)))
+
+class LibraryEntry:
+    """
+        A view of one file of a LibraryIndex that behaves like a FileInfo. Views are created on demand, so two views of the same
+        file are equal but not the same object.
+    """
+    __slots__ = ("library", "position")
+
+    def __init__(self, library: LibraryIndex, position):
+        self.library = library
+        self.position = position
+
+    @property
+    def full_path(self):
+        return self.library.full_path(self.position)
+
+    @property
+    def filename(self):
+        return self.library.filename(self.position)
+
+    def get_tag(self):
+        tag = self.library.get_tag(self.position)
+        if tag is TAG_NOT_LOADED:
+            self.update_tag_from_fs()
+            tag = self.library.get_tag(self.position)
+        return tag
+
+    def set_tag(self, tag):
+        self.library.set_tag(self.position, tag)
+
+    tag = property(get_tag, set_tag)
+
+    @property
+    def audio_info(self):
+        return self.library.get_audio_info(self.position)
+
+    @audio_info.setter
+    def audio_info(self, audio_info):
+        self.library.set_audio_info(self.position, audio_info)
+
+    def is_tag_loaded(self):
+        return self.library.artists[self.position] != LIBRARY_TAG_NOT_LOADED
+
+    def is_tag_set(self):
+        # from the numbers, without building a FileTag
+        if not self.is_tag_loaded():
+            self.update_tag_from_fs()
+        numbers = self.library.tag_numbers(self.position)
+        return numbers[0] != LIBRARY_NO_TAG and any(self.library.strings[number] for number in numbers)
+
+    def get_plain_filename(self):
+        return os.path.splitext(self.filename)[0]
+
+    def get_audio_info(self):
+        if self.audio_info is None:
+            self.audio_info = read_audio_info_from_fs(self.full_path)
+        return self.audio_info
+
+    def update_tag_from_fs(self):
+        self.tag, self.audio_info = read_tag_from_fs(self.full_path)
+
+    def get_normalized(self):
+        """
+            Not stored per file. The normalized strings are stored once in the library.
+        """
+        if not self.is_tag_loaded():
+            self.update_tag_from_fs()
+        return self.library.normalized(self.position)
+
+    def __eq__(self, other):
+        return isinstance(other, LibraryEntry) and other.library is self.library and other.position == self.position
+
+    def __hash__(self):
+        return hash((id(self.library), self.position))
+
+    def __repr__(self):
+        return "LibraryEntry(full_path={!r}, filename={!r}, tag={!r})".format(self.full_path, self.filename, self.library.get_tag(self.position))
+
+def as_library(file_infos):
+    """
+        Returns a LibraryIndex as it is and anything else as a list. A list of a LibraryIndex would hold a view of every file.
+    """
+    return file_infos if isinstance(file_infos, LibraryIndex) else list(file_infos)
+
+def open_cache_db(db_path=CACHE_DB_PATH):
+    """
+        Returns a connection to the sqlite database that holds all persistent caches.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    return sqlite3.connect(db_path)
+
+def ensure_cache_table(db, name, columns, rebuild=False):
+    """
+        Creates the table if needed. An existing table with different columns, e.g. from an older version of this script, is replaced.
+        columns is a list of sqlite column definitions like "path TEXT PRIMARY KEY".
+    """
+    wanted = [column.split()[0] for column in columns if not column.startswith("PRIMARY KEY")]
+    existing = [row[1] for row in db.execute("PRAGMA table_info({})".format(name))]
+    if rebuild or (existing and existing != wanted):
+        db.execute("DROP TABLE IF EXISTS {}".format(name))
+    db.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(name, ", ".join(columns)))
+
+def file_signature(path):
+    """
+        Returns (size, mtime_ns) of the file, used to decide whether cached info is still valid.
+    """
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime_ns)
+
+class TagCache:
+    """
+        Persistent cache of the FileTags and AudioInfos read by FileInfo.update_tag_from_fs, keyed by path.
+        An entry is only used while the file still has the same size and mtime.
+    """
+    def __init__(self, db_path=CACHE_DB_PATH, rebuild=REBUILD_TAG_CACHE):
+        self.db = open_cache_db(db_path)
+        ensure_cache_table(self.db, "tags", ["path TEXT PRIMARY KEY", "size INTEGER", "mtime_ns INTEGER", "has_tag INTEGER", "artist TEXT", "album TEXT", "title TEXT",
+            "bitrate INTEGER", "length REAL", "codec TEXT", "sample_rate INTEGER"], rebuild=rebuild)
+        # one sequential read of the whole table is much faster than one query per file
+        self.entries = { row[0]: row[1:] for row in self.db.execute("SELECT path, size, mtime_ns, has_tag, artist, album, title, bitrate, length, codec, sample_rate FROM tags") }
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, file_info, signature):
+        """
+            Sets the tag and audio info of file_info from the cache and returns True, or returns False if there is no valid entry.
+        """
+        entry = self.entries.get(file_info.full_path)
+        if entry is None or (entry[0], entry[1]) != signature:
+            self.misses += 1
+            return False
+        _size, _mtime_ns, has_tag, artist, album, title, bitrate, length, codec, sample_rate = entry
+        file_info.tag = FileTag(artist=artist, album=album, title=title) if has_tag else None
+        file_info.audio_info = AudioInfo(bitrate=bitrate, length=length, codec=codec, sample_rate=sample_rate)
+        self.hits += 1
+        return True
+
+    def store(self, file_info, signature):
+        tag = file_info.tag
+        audio_info = file_info.get_audio_info()
+        entry = (signature[0], signature[1], tag is not None,
+                tag.artist if tag else None, tag.album if tag else None, tag.title if tag else None,
+                audio_info.bitrate, audio_info.length, audio_info.codec, audio_info.sample_rate)
+        self.entries[file_info.full_path] = entry
+        self.db.execute("INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (file_info.full_path,) + entry)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+def read_tag_from_fs(full_path):
+    """
+        Returns the FileTag of the file, or None, and its AudioInfo. Module-level so that worker processes can run it.
+    """
+    file_info = FileInfo(full_path=full_path, filename=os.path.basename(full_path))
+    file_info.update_tag_from_fs()
+    return file_info.tag, file_info.audio_info
+
+def map_with_workers(function, items, workers=1, use_processes=False, progress_label=None, progress_every=200, mp_context=None):
+    """
+        Like map(function, items), but spread over a pool of threads or processes.
+        The results are yielded in the same order as the items.
+        mp_context is the multiprocessing context used for processes, e.g. to fork them.
+    """
+    items = list(items)
+    total = len(items)
+    if workers is None or workers <= 1 or total <= 1:
+        results = map(function, items)
+        pool = None
+    elif use_processes:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+        results = pool.map(function, items, chunksize=max(1, min(64, total // (4*workers))))
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        results = pool.map(function, items)
+    try:
+        for progressctr, result in enumerate(results, start=1):
+            if progress_label and progressctr % progress_every == 0:
+                print("[{}]: Progress {} / {}".format(progress_label, progressctr, total))
+            yield result
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+def update_tags_from_fs(file_infos, tag_cache: TagCache = None, workers=TAG_INDEX_WORKERS, use_processes=TAG_INDEX_USE_PROCESSES):
+    """
+        Sets the tag and audio info of every FileInfo, like calling update_tag_from_fs on each of them.
+        Files that the tag cache already knows unchanged are not read at all, the others are read by a pool of workers.
+    """
+    to_read = [] # (file_info, signature or None)
+    for file_info in file_infos:
+        if tag_cache is None:
+            to_read.append((file_info, None))
+            continue
+        try:
+            signature = file_signature(file_info.full_path)
+        except OSError:
+            signature = None
+        if signature is not None and tag_cache.load(file_info, signature):
+            continue
+        to_read.append((file_info, signature))
+
+    tags = map_with_workers(read_tag_from_fs, [file_info.full_path for file_info, _signature in to_read],
+            workers=workers, use_processes=use_processes, progress_label="TAGS")
+    for (file_info, signature), (tag, audio_info) in zip(to_read, tags):
+        file_info.tag = tag
+        file_info.audio_info = audio_info
+        if tag_cache is not None and signature is not None:
+            tag_cache.store(file_info, signature)
+
+    if tag_cache is not None:
+        tag_cache.db.commit()
+        print("Tag cache: {} hits, {} misses".format(tag_cache.hits, tag_cache.misses))
+
+class TagIndex:
+    """
+        Built once from a list of FileInfos, so that exact tag matches don't need to scan the whole library.
+
+        FileTag.set_parts_equal ignores the parts of a file tag that are not set. So every file is stored
+        under its tag with the unset parts replaced by None, and a lookup tries all combinations of the
+        song's parts with None. The earliest file in the original list wins, just like the linear scan.
+    """
+    def __init__(self, file_infos):
+        self.file_infos = as_library(file_infos)
+        self.first_position = {} # maps (artist, title, album) with None for unset parts to the first index in file_infos
+        for position, file_info in enumerate(self.file_infos):
+            if file_info.is_tag_set():
+                key = TagIndex.key_of_tag(file_info.tag)
+                if key not in self.first_position:
+                    self.first_position[key] = position
+
+    @staticmethod
+    def key_of_tag(tag):
+        return (tag.artist or None, tag.title or None, tag.album or None)
+
+    def find_exact(self, artist, title, album):
+        """
+            Returns the first FileInfo whose tag set_parts_equal the given parts, or None.
+        """
+        best = None
+        for key in ((a, t, al) for a in (artist, None) for t in (title, None) for al in (album, None)):
+            position = self.first_position.get(key)
+            if position is not None and (best is None or position < best):
+                best = position
+        return None if best is None else self.file_infos[best]
+
+    def __len__(self):
+        return len(self.file_infos)
 
 def debug_m(track, music_path=MUSIC_PATH):
     local_music_file_infos = [FileInfo(filename=filpath, full_path=os.path.abspath(os.path.join(dirpath, filpath))) for (dirpath, _dirs, filpaths) in os.walk(music_path) for filpath in filpaths ]
@@ -353,11 +1302,20 @@ def debug_m(track, music_path=MUSIC_PATH):
     a=find_match(track, local_music_files)
     print(a if a else "No match")
 
-def find_exact_tag_match(local_music_file_infos, song_info, tracker: MatchTracker, playlist):
+def find_exact_tag_match(local_music_file_infos, song_info, tracker: MatchTracker, playlist, tag_index: TagIndex = None):
     """
         Returns True if an exact match was found, False otherwise.
         When the first exact match is found, the search calls match and returns.
+        If a TagIndex built from local_music_file_infos is given, it is used instead of scanning the list.
     """
+    if tag_index is not None:
+        music_file_info = tag_index.find_exact(artist=song_info.artist, title=song_info.title, album=song_info.album)
+        if music_file_info is None:
+            return False
+        print("Exact Tag Match for {title} by {artist} from Album {album} at path {tpath}".format(title=song_info.title, album=song_info.album, artist=song_info.artist, tpath=music_file_info.full_path))
+        tracker.match(song_info, music_file_info.full_path, MatchSource.EXACT_TAG_MATCH, playlist=playlist)
+        return True
+
     for music_file_info in local_music_file_infos:
         if music_file_info.is_tag_set():
             tag = music_file_info.tag
@@ -374,7 +1332,19 @@ def find_exact_tag_match(local_music_file_infos, song_info, tracker: MatchTracke
                 pass
     return False
 
-def find_substring_tag_match(fallback_music_file_infos, song_info, fallback_tracker, playlist: Playlist):
+def find_substring_tag_match(fallback_music_file_infos, song_info, fallback_tracker, playlist: Playlist, fallback_index=None):
+    """
+        Returns True if a file was found whose title (and album and artist, if set) is contained in the song's.
+        If a FallbackIndex built from fallback_music_file_infos is given, it is used instead of scanning the list.
+    """
+    if fallback_index is not None:
+        music_file_info = fallback_index.find_substring(song_info)
+        if music_file_info is None:
+            return False
+        print("Substring Tag Match for {title} by {artist} from Album {album} at path {tpath}".format(title=song_info.title, album=song_info.album, artist=song_info.artist, tpath=music_file_info.full_path))
+        fallback_tracker.match(song_info, music_file_info.full_path, MatchSource.SUBSTRING_TAG_MATCH, playlist=playlist)
+        return True
+
     for music_file_info in fallback_music_file_infos:
         if music_file_info.is_tag_set():
             tag = music_file_info.tag
@@ -388,14 +1358,35 @@ def find_substring_tag_match(fallback_music_file_infos, song_info, fallback_trac
     return False
 
 
-def find_fuzzy_tag_match(local_music_file_infos, song_info, tracker: MatchTracker, playlist: Playlist):
-    possibilities = ["{}{}".format(mf_info.tag.title, mf_info.tag.artist) for mf_info in local_music_file_infos if mf_info.is_tag_set()]
-    found = find_match("{}{}".format(song_info.title, song_info.artist), possibilities, cutoff=0.4)
+def fuzzy_tag_engine(local_music_file_infos, method=FUZZY_MATCH_METHOD):
+    """
+        A SimilarityEngine over the tag keys that find_fuzzy_tag_match compares, with the file paths as values.
+    """
+    tagged = [mf_info for mf_info in local_music_file_infos if mf_info.is_tag_set()]
+    return SimilarityEngine([mf_info.get_normalized().fuzzy_tag_key for mf_info in tagged], values=[mf_info.full_path for mf_info in tagged], method=method)
+
+def fuzzy_filename_engine(local_music_file_infos, method=FUZZY_MATCH_METHOD):
+    """
+        A SimilarityEngine over the file names that find_fuzzy_match compares, with the file paths as values.
+    """
+    return SimilarityEngine([f.filename for f in local_music_file_infos], values=[f.full_path for f in local_music_file_infos], method=method)
+
+def find_fuzzy_tag_match(local_music_file_infos, song_info, tracker: MatchTracker, playlist: Playlist, engine: SimilarityEngine = None):
+    """
+        If a fuzzy_tag_engine of local_music_file_infos is given, it is used instead of difflib over the whole list.
+    """
+    if engine is not None:
+        found = find_match(song_info.fuzzy_tag_key, None, cutoff=0.4, engine=engine)
+        found_path = None if found is None else engine.value_of(found)
+    else:
+        possibilities = [mf_info.get_normalized().fuzzy_tag_key for mf_info in local_music_file_infos if mf_info.is_tag_set()]
+        found = find_match(song_info.fuzzy_tag_key, possibilities, cutoff=0.4)
+        if found is not None:
+            found_music_file_infos = list(filter(
+                    lambda mfi: mfi.is_tag_set() and (mfi.get_normalized().fuzzy_tag_key == found),
+                    local_music_file_infos))
+            found_path = found_music_file_infos[0].full_path
     if found is not None:
-        found_music_file_infos = list(filter(
-                lambda mfi: mfi.is_tag_set() and ("{}{}".format(mfi.tag.title, mfi.tag.artist) == found),
-                local_music_file_infos))
-        found_path = found_music_file_infos[0]
         # but just because this matches does not yet mean it's valid. E.g. "Vitas - My Swan" matched "Starset - My Demons"...
         print("Fuzzy Tag Match for {title} by {artist} from Album {album} to path {tpath}".format(
                 title=song_info.title, album=song_info.album, artist=song_info.artist, tpath=found_path
@@ -404,18 +1395,22 @@ def find_fuzzy_tag_match(local_music_file_infos, song_info, tracker: MatchTracke
         return True
     return False
 
-def find_fuzzy_match(local_music_file_infos, song_info, searchterm: str, tracker: MatchTracker, playlist: Playlist):
+def find_fuzzy_match(local_music_file_infos, song_info, searchterm: str, tracker: MatchTracker, playlist: Playlist, engine: SimilarityEngine = None):
     """
         Return True if found, false otherwise. If found, calls match.
+        If a fuzzy_filename_engine of local_music_file_infos is given, it is used instead of difflib over the whole list.
     """
     song_name = find_match(searchterm.format(title=song_info.title, artist=song_info.artist, album=song_info.album, cutoff=0.3),
-        [f.filename for f in local_music_file_infos]
+        None if engine is not None else [f.filename for f in local_music_file_infos], engine=engine
     )
     if song_name is None:
         return False
     else:
         # We found the song path that belongs to this song_info!
-        song_path = [f.full_path for f in local_music_file_infos if f.filename == song_name][0]
+        if engine is not None:
+            song_path = engine.value_of(song_name)
+        else:
+            song_path = [f.full_path for f in local_music_file_infos if f.filename == song_name][0]
         print("Fuzzy Match for {title} by {artist} from Album {album} to path {tpath}".format(
             title=song_info.title, album=song_info.album, artist=song_info.artist,
             tpath=song_path
@@ -431,40 +1426,122 @@ def x_fuzzily_contains_y(x:str, y:str):
         return False
     if x is None: 
         return False
-    xx = x.lower().replace('&amp;', '&').replace('&#39;',"'").replace('&quot;','"')
-    # split on non-word characters of any amount, or underscore, or dash (included in non-word characters)
-    splitmagic='[\W_]+'
-    yys = [ item for item in re.split(splitmagic,y.lower().replace('&amp;', '&').replace('&#39;', "'").replace('&quot;', '"')) if item != '' ]
+    xx = fuzzy_normalize(x)
+    yys = fuzzy_tokens(y)
     if all([yy in xx for yy in yys]):
         return True
     else:
         return False
 
+class NgramIndex:
+    """
+        Finds the texts that might contain all of some tokens as substrings, without looking at every text.
+        Every token that is a substring of a text shares all its n-grams with that text, so the texts that contain
+        all n-grams of all tokens are a superset of the real matches. The caller still has to check the candidates.
+    """
+    def __init__(self, texts, n=3, enough_candidates=32):
+        """
+            texts: a list of already normalized strings, or None for entries that should never be candidates.
+        """
+        self.n = n
+        self.enough_candidates = enough_candidates
+        self.all_positions = [i for i, text in enumerate(texts) if text is not None]
+        self.postings = {} # maps n-gram to array of positions, in ascending order
+        for position, text in enumerate(texts):
+            if text is None:
+                continue
+            for gram in { text[i:i+n] for i in range(len(text) - n + 1) }:
+                posting = self.postings.get(gram)
+                if posting is None:
+                    posting = self.postings[gram] = array.array('I')
+                posting.append(position)
+
+    def candidates(self, tokens):
+        """
+            Returns the ascending positions of the texts that might contain all the tokens.
+        """
+        grams = { token[i:i+self.n] for token in tokens for i in range(len(token) - self.n + 1) }
+        if not grams:
+            # only tokens shorter than n, they can't be looked up
+            return self.all_positions
+        postings = sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+        result = set(postings[0])
+        for posting in postings[1:]:
+            if len(result) <= self.enough_candidates:
+                # checking a few candidates is cheaper than intersecting with the long postings of common n-grams
+                break
+            result.intersection_update(posting)
+        return sorted(result)
+
+class ContainsIndex:
+    """
+        Precomputed n-gram indices over the normalized tag titles and paths of the library,
+        so that tags_contain_info and filepath_contains_info only need to check a few candidate files.
+        The candidates are checked against the normalized strings stored here by position, and only the matching files are looked up.
+    """
+    def __init__(self, file_infos):
+        self.file_infos = as_library(file_infos)
+        # the parts of the NormalizedFileInfo of each file. The tag parts are None if the tag is not set.
+        self.titles, self.artists, self.albums, self.paths = [], [], [], []
+        for mfi in self.file_infos:
+            normalized = mfi.get_normalized()
+            self.titles.append(normalized.title)
+            self.artists.append(normalized.artist)
+            self.albums.append(normalized.album)
+            self.paths.append(normalized.path)
+        self.title_index = NgramIndex(self.titles)
+        self.path_index = NgramIndex(self.paths)
+
+    def tag_matches(self, song_info):
+        """
+            FileInfos in library order whose tags fuzzily contain the song's, as checked by tags_contain_info.
+            An unset tag part always matches, and so does the album if the song has no artist.
+        """
+        titles, artists, albums = self.titles, self.artists, self.albums
+        return [self.file_infos[position] for position in self.title_index.candidates(song_info.title_tokens)
+                if fuzzily_contains(titles[position], song_info.title_tokens)
+                and ((not artists[position]) or (not song_info.artist) or fuzzily_contains(artists[position], song_info.artist_tokens))
+                and ((not albums[position]) or (not song_info.artist) or fuzzily_contains(albums[position], song_info.album_tokens))]
+
+    def path_matches(self, song_info):
+        """
+            FileInfos in library order whose path fuzzily contains the song's title and its artist or album, as checked by filepath_contains_info.
+        """
+        paths = self.paths
+        return [self.file_infos[position] for position in self.path_index.candidates(song_info.title_tokens)
+                if fuzzily_contains(paths[position], song_info.title_tokens)
+                and (fuzzily_contains(paths[position], song_info.artist_tokens) or fuzzily_contains(paths[position], song_info.album_tokens))]
+
 def best_bitrate_file(mfi_filelist):
     if len(mfi_filelist) < 1:
         return None
-    fl = [(mutagen.File(item.full_path).info.bitrate, item) for item in mfi_filelist]
+    fl = [(item.get_audio_info().bitrate, item) for item in mfi_filelist]
     sl = sorted(fl, reverse=True, key=lambda x:x[0])
     return sl[0][1]
 
 def kinda_equal(a, b):
     return x_fuzzily_contains_y(a,b) and x_fuzzily_contains_y(b,a)
 
-def tags_contain_info(local_music_file_infos, song_info, tracker, playlist: Playlist):
+def tags_contain_info(local_music_file_infos, song_info, tracker, playlist: Playlist, contains_index: ContainsIndex = None):
     """
         Return True if a match found
+        If a ContainsIndex built from local_music_file_infos is given, only its candidates are checked.
     """
-    found_mfi_options = []
-    for mfi in local_music_file_infos:
-        if mfi.is_tag_set():
-            # only check the options that are set. If no tags are set, we ignore the file. The title is required. But artist and album not.
-            good=False
-            if x_fuzzily_contains_y(x=mfi.tag.title, y=song_info.title):
-                if (not mfi.tag.artist) or (not song_info.artist) or x_fuzzily_contains_y(x=mfi.tag.artist, y=song_info.artist):
-                    if (not mfi.tag.album) or (not song_info.artist) or x_fuzzily_contains_y(x=mfi.tag.album, y=song_info.album):
-                        good=True
-            if good:
-                found_mfi_options.append(mfi)
+    if contains_index is not None and song_info.title is not None:
+        found_mfi_options = contains_index.tag_matches(song_info)
+    else:
+        found_mfi_options = []
+        for mfi in local_music_file_infos:
+            if mfi.is_tag_set():
+                # only check the options that are set. If no tags are set, we ignore the file. The title is required. But artist and album not.
+                good=False
+                normalized = mfi.get_normalized()
+                if fuzzily_contains(normalized.title, song_info.title_tokens):
+                    if (not mfi.tag.artist) or (not song_info.artist) or fuzzily_contains(normalized.artist, song_info.artist_tokens):
+                        if (not mfi.tag.album) or (not song_info.artist) or fuzzily_contains(normalized.album, song_info.album_tokens):
+                            good=True
+                if good:
+                    found_mfi_options.append(mfi)
     num_found =  len(found_mfi_options)
     if num_found == 1:
         print("TCInfo found match for {title} by {artist} from Album {album} to path {tpath}".format(
@@ -486,13 +1563,17 @@ def tags_contain_info(local_music_file_infos, song_info, tracker, playlist: Play
                     return True
         return False
 
-def filepath_contains_info(local_music_file_infos, song_info, tracker, playlist: Playlist):
-    found_mfi_options = []
-    for mfi in local_music_file_infos:
-        if x_fuzzily_contains_y(x=mfi.full_path, y=song_info.title):
-            if x_fuzzily_contains_y(x=mfi.full_path, y=song_info.artist) \
-            or x_fuzzily_contains_y(x=mfi.full_path, y=song_info.album):
-                found_mfi_options.append(mfi)
+def filepath_contains_info(local_music_file_infos, song_info, tracker, playlist: Playlist, contains_index: ContainsIndex = None):
+    if contains_index is not None and song_info.title is not None:
+        found_mfi_options = contains_index.path_matches(song_info)
+    else:
+        found_mfi_options = []
+        for mfi in local_music_file_infos:
+            normalized_path = mfi.get_normalized().path
+            if fuzzily_contains(normalized_path, song_info.title_tokens):
+                if fuzzily_contains(normalized_path, song_info.artist_tokens) \
+                or fuzzily_contains(normalized_path, song_info.album_tokens):
+                    found_mfi_options.append(mfi)
 
     num_found= len(found_mfi_options)
     if num_found == 1:
@@ -524,21 +1605,353 @@ def is_ignored(folder):
     folders= folders_of_path(path)
     return any([item in folders for item in IGNORE_MUSIC_FOLDERS])
 
-def save_playlist_files(playlists: list, outdir=OUTPUT_PLAYLIST_DIR):
+def list_directory(path):
+    """
+        Returns (names of the subfolders to walk into, names of the files) like os.walk: links to folders are neither files nor walked into.
+    """
+    subdirs = []
+    files = []
+    for entry in os.scandir(path):
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if not is_dir:
+            files.append(entry.name)
+        elif not entry.is_symlink():
+            subdirs.append(entry.name)
+    return subdirs, files
+
+class DirectoryIndex:
+    """
+        Persistent listing of the folders below the music folders, keyed by path.
+        A folder is only listed again if its mtime changed, which happens whenever an entry is added, removed or renamed in it.
+    """
+    def __init__(self, db_path=CACHE_DB_PATH, rebuild=REBUILD_DIRECTORY_INDEX):
+        self.db = open_cache_db(db_path)
+        ensure_cache_table(self.db, "directories", ["path TEXT PRIMARY KEY", "mtime_ns INTEGER", "subdirs TEXT", "files TEXT"], rebuild=rebuild)
+        self.entries = { row[0]: row[1:] for row in self.db.execute("SELECT path, mtime_ns, subdirs, files FROM directories") }
+        self.seen = set()
+        self.changed = set() # written to the database by close, so that several threads can walk at the same time
+        self.lock = threading.Lock()
+        self.listed = 0
+        self.reused = 0
+
+    def listing(self, path):
+        """
+            Same as list_directory, but from the index if the folder did not change.
+        """
+        mtime_ns = os.stat(path).st_mtime_ns
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == mtime_ns:
+            with self.lock:
+                self.seen.add(path)
+                self.reused += 1
+            # file names can't contain NUL, so it separates them
+            return [name for name in entry[1].split("\0") if name], [name for name in entry[2].split("\0") if name]
+        subdirs, files = list_directory(path)
+        with self.lock:
+            self.entries[path] = (mtime_ns, "\0".join(subdirs), "\0".join(files))
+            self.seen.add(path)
+            self.changed.add(path)
+            self.listed += 1
+        return subdirs, files
+
+    def prune(self):
+        """
+            Forgets the folders that were not walked since the index was opened. Returns how many were forgotten.
+        """
+        gone = [path for path in self.entries if path not in self.seen]
+        for path in gone:
+            del self.entries[path]
+        self.db.executemany("DELETE FROM directories WHERE path = ?", ((path,) for path in gone))
+        return len(gone)
+
+    def close(self):
+        self.db.executemany("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)", ((path,) + self.entries[path] for path in self.changed if path in self.entries))
+        self.db.commit()
+        self.db.close()
+
+def walk_files(root, dir_index: DirectoryIndex = None, ignored=None):
+    """
+        Returns the paths of all files below root, in the same order as os.walk.
+        Folders named like one of the ignored (default IGNORE_MUSIC_FOLDERS) are not walked into at all.
+    """
+    ignored = set(IGNORE_MUSIC_FOLDERS if ignored is None else ignored)
+    if any(folder in ignored for folder in folders_of_path(root)):
+        return []
+    paths = []
+    stack = [root]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            subdirs, files = dir_index.listing(dirpath) if dir_index is not None else list_directory(dirpath)
+        except OSError:
+            continue # os.walk skips unreadable folders as well
+        paths.extend(os.path.join(dirpath, name) for name in files)
+        stack.extend(os.path.join(dirpath, name) for name in reversed(subdirs) if name not in ignored)
+    return paths
+
+class SubstringAutomaton:
+    """
+        Aho-Corasick automaton over a fixed list of patterns. One pass over a text finds all patterns that are contained in it,
+        no matter how many patterns there are.
+    """
+    def __init__(self, patterns):
+        self.goto = [{}] # per state, maps a character to the next state
+        self.outputs = [[]] # per state, the numbers of the patterns that end there
+        for number, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.outputs.append([])
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.outputs[state].append(number)
+        # fail: the state of the longest proper suffix that is in the trie. output_link: the next state on the fail chain
+        # that has outputs, 0 if there is none. Computed breadth first, so the fail state is always done already.
+        self.fail = [0] * len(self.goto)
+        self.output_link = [0] * len(self.goto)
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[next_state] = fail
+                self.output_link[next_state] = fail if fail and self.outputs[fail] else self.output_link[fail]
+
+    def find_all(self, text):
+        """
+            Returns the set of the numbers of all patterns that are contained in text. An empty pattern is contained in every text.
+        """
+        goto, fail, outputs, output_link = self.goto, self.fail, self.outputs, self.output_link
+        found = set(outputs[0])
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            match = state if outputs[state] else output_link[state]
+            while match:
+                found.update(outputs[match])
+                match = output_link[match]
+        return found
+
+class FallbackIndex:
+    """
+        The files of all GPM_FALLBACK_TRACK_PATHS in one list. Each file is tagged with the root it was found in and that root's
+        priority, which is its position in GPM_FALLBACK_TRACK_PATHS. The files are sorted by priority, so if several files match,
+        the one from the earliest root wins.
+
+        The lookup structures are built by build_lookups once the tags are loaded.
+        If the files of every root are in a LibraryIndex, file_infos is one LibraryIndex of all of them.
+    """
+    def __init__(self, roots, file_infos_per_root):
+        self.roots = list(roots)
+        file_infos_per_root = list(file_infos_per_root)
+        compact = bool(file_infos_per_root) and all(isinstance(file_infos, LibraryIndex) for file_infos in file_infos_per_root)
+        self.file_infos = LibraryIndex() if compact else []
+        self.priorities = array.array('i') # the priority of the root of each file in file_infos
+        for priority, file_infos in enumerate(file_infos_per_root):
+            self.file_infos.extend(file_infos)
+            self.priorities.extend([priority] * len(file_infos))
+        self.tag_index = None
+        self.title_positions = None
+        self.title_automaton = None
+
+    @staticmethod
+    def from_roots(roots, dir_index: DirectoryIndex = None, workers=FALLBACK_INDEX_WORKERS, compact=COMPACT_LIBRARY_INDEX):
+        """
+            Walks all roots at the same time. If compact, the files of each root are stored in a LibraryIndex.
+        """
+        roots = [os.path.normpath(root) for root in roots]
+        if compact:
+            walk = lambda root: LibraryIndex.from_paths(walk_files(root, dir_index=dir_index))
+        else:
+            walk = lambda root: [FileInfo(filename=os.path.basename(path), full_path=path) for path in walk_files(root, dir_index=dir_index)]
+        return FallbackIndex(roots, map_with_workers(walk, roots, workers=workers))
+
+    def root_of(self, position):
+        return self.roots[self.priorities[position]]
+
+    def files_per_root(self):
+        counts = collections.Counter(self.priorities)
+        return { root: counts[priority] for priority, root in enumerate(self.roots) }
+
+    def build_lookups(self):
+        """
+            Builds the structures for find_exact and find_substring. The tags of all files must be loaded.
+        """
+        self.tag_index = TagIndex(self.file_infos)
+        # Many files share a title, so the automaton only knows each distinct title once
+        positions_by_title = {}
+        for position, file_info in enumerate(self.file_infos):
+            if file_info.is_tag_set():
+                positions_by_title.setdefault(file_info.tag.title, []).append(position)
+        self.title_positions = list(positions_by_title.values())
+        self.title_automaton = SubstringAutomaton(positions_by_title.keys())
+
+    def find_exact(self, song_info):
+        return self.tag_index.find_exact(artist=song_info.artist, title=song_info.title, album=song_info.album)
+
+    def candidate_positions(self, song_title):
+        """
+            Returns, per title of a file that is contained in song_title, the positions of the files with that title in ascending order.
+            Sorted by the first position.
+        """
+        return sorted((self.title_positions[number] for number in self.title_automaton.find_all(song_title)), key=lambda positions: positions[0])
+
+    def find_substring(self, song_info):
+        """
+            Returns the first file, like the linear scan of find_substring_tag_match, whose title is contained in the song's title
+            and whose album and artist are contained in the song's unless one of them is not set. Or None.
+        """
+        best = None
+        for positions in self.candidate_positions(song_info.title):
+            if best is not None and positions[0] >= best:
+                break
+            for position in positions:
+                if best is not None and position >= best:
+                    break
+                tag = self.file_infos[position].tag
+                if (not tag.album) or (not song_info.album) or tag.album in song_info.album:
+                    if (not tag.artist) or (not song_info.artist) or tag.artist in song_info.artist:
+                        best = position
+                        break
+        return None if best is None else self.file_infos[best]
+
+    def __len__(self):
+        return len(self.file_infos)
+
+class WrittenPlaylistStore:
+    """
+        Remembers the content hash and the signature of every playlist file that was written, so that an unchanged
+        playlist is neither written nor read again.
+    """
+    def __init__(self, db_path=CACHE_DB_PATH):
+        self.db = open_cache_db(db_path)
+        ensure_cache_table(self.db, "written_playlists", ["path TEXT PRIMARY KEY", "size INTEGER", "mtime_ns INTEGER", "content_hash TEXT"])
+
+    def is_unchanged(self, path, content_hash):
+        """
+            True if the file at path was written with this content hash and was not modified since.
+        """
+        row = self.db.execute("SELECT size, mtime_ns, content_hash FROM written_playlists WHERE path = ?", (path,)).fetchone()
+        if row is None or row[2] != content_hash:
+            return False
+        try:
+            return file_signature(path) == (row[0], row[1])
+        except OSError:
+            return False
+
+    def put(self, path, content_hash):
+        self.db.execute("INSERT OR REPLACE INTO written_playlists VALUES (?, ?, ?, ?)", (path,) + file_signature(path) + (content_hash,))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+def write_file_atomically(path, text):
+    """
+        Writes text to a temporary file next to path and renames it to path, so that path is never half written.
+    """
+    # not tempfile.mkstemp, because its files are only readable by their owner
+    temp_path = os.path.join(os.path.dirname(path), ".{}.{}.tmp".format(os.path.basename(path), os.getpid()))
+    try:
+        with open(temp_path, "w", encoding="utf-8") as outfile:
+            outfile.write(text)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def extinf_line(file_info):
+    """
+        Returns the #EXTINF line of the file from the tag and audio info that are known already, or None if neither is.
+        Never reads the file.
+    """
+    tag = file_info.tag if file_info.is_tag_loaded() else None
+    audio_info = file_info.audio_info
+    if tag is None and audio_info is None:
+        return None
+    seconds = round(audio_info.length) if audio_info is not None and audio_info.length else -1 # -1 means unknown
+    title = (tag.title if tag is not None else "") or file_info.get_plain_filename()
+    artist = tag.artist if tag is not None else ""
+    display = "{} - {}".format(artist, title) if artist else title
+    return "#EXTINF:{},{}".format(seconds, " ".join(display.splitlines()))
+
+def collect_extinfs(playlists: list, file_infos, tag_cache: TagCache = None, copied: dict = None):
+    """
+        Returns a dict of the paths in the playlists to their #EXTINF lines, from the FileInfos of those paths.
+        Tags that were not loaded are taken from the tag cache if it knows the file unchanged, but no file is read.
+        copied maps paths to the paths of the files they are copies of, see copy_files_over.
+    """
+    copied = copied or {}
+    needed = { path for playlist in playlists for path in playlist.get_content() }
+    needed.update(copied[path] for path in list(needed) if path in copied)
+    extinfs = {}
+    for file_info in file_infos:
+        path = file_info.full_path
+        if path not in needed or path in extinfs:
+            continue
+        if tag_cache is not None and not file_info.is_tag_loaded():
+            try:
+                tag_cache.load(file_info, file_signature(path))
+            except OSError:
+                pass
+        line = extinf_line(file_info)
+        if line is not None:
+            extinfs[path] = line
+    for target, source in copied.items():
+        if source in extinfs and target not in extinfs:
+            extinfs[target] = extinfs[source]
+    return extinfs
+
+def save_playlist_files(playlists: list, outdir=OUTPUT_PLAYLIST_DIR, store: WrittenPlaylistStore = None, extinfs: dict = None):
     """
         Takes a List<Playlist> and writes it out to files.
+        Each playlist is built in memory and written at once. Playlists whose file already has the same content are not written.
+        With a store, that is decided from the stored content hash without reading the file.
+        If extinfs is given, the files are extended M3U, and each line that is in extinfs is preceded by its #EXTINF line.
     """
     os.makedirs(os.path.normpath(outdir), exist_ok=True)
+    written = 0
     for playlist in playlists:
         pfile = os.path.join(outdir, "{}.m3u".format(playlist.name))
-        with open(pfile, "w+", encoding="utf-8") as outfile:
-            for line in playlist.get_content():
-                outfile.write(line+"\n")
+        if extinfs is None:
+            text = "".join(line + "\n" for line in playlist.get_content())
+        else:
+            text = "#EXTM3U\n" + "".join((extinfs[line] + "\n" + line + "\n") if line in extinfs else (line + "\n") for line in playlist.get_content())
+        content_hash = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        if store is not None:
+            if store.is_unchanged(pfile, content_hash):
+                continue
+        else:
+            try:
+                with open(pfile, "r", encoding="utf-8", newline=None) as infile:
+                    if infile.read() == text:
+                        continue
+            except (OSError, UnicodeDecodeError):
+                pass
+        write_file_atomically(pfile, text)
+        written += 1
+        if store is not None:
+            store.put(pfile, content_hash)
+    print("Wrote {} of {} playlists to {}, the others did not change.".format(written, len(playlists), outdir))
 
-def complete_playlists_interactively(playlists: list):
+def complete_playlists_interactively(playlists: list, match_store=None):
     """
         Asks user for inputs for the missing paths and returns an updated list.
         Modifies the Playlists!
+        If a MatchStore is given, the paths the user specified are remembered there for the next runs.
     """
     user_specifiable_mappings = {}
     infostring="SPECIFY_PATH_HERE"
@@ -603,6 +2016,10 @@ def complete_playlists_interactively(playlists: list):
         print("Thanks!", file=sys.stderr)
     for playlist in playlists:
         playlist.update_placeholders(user_specifiable_mappings)
+    if match_store is not None:
+        for key, value in user_specifiable_mappings.items():
+            match_store.put_user_specified(key, value)
+        match_store.commit()
 
     return playlists
 
@@ -614,10 +2031,11 @@ def path_a_in_b(a, b):
     bb = os.path.normpath(b)
     return aa.startswith(os.path.abspath(bb) + os.sep) or aa == bb
 
-def copy_files_over(playlists: list, targetdir=COPY_FALLBACKS_TO_PATH, musicdir=MUSIC_PATH):
+def copy_files_over(playlists: list, targetdir=COPY_FALLBACKS_TO_PATH, musicdir=MUSIC_PATH, copied: dict = None):
     """
         Copy files to path unless they are located in the musicpath already.
         Modifies the Playlists!
+        If copied is given, each path a file was copied to is mapped to the path it was copied from there.
     """
     os.makedirs(os.path.normpath(targetdir), exist_ok=True)
     for playlist in playlists:
@@ -629,6 +2047,8 @@ def copy_files_over(playlists: list, targetdir=COPY_FALLBACKS_TO_PATH, musicdir=
                 target_path = os.path.normpath(os.path.join(targetdir, filename))
                 if not os.path.exists(target_path) or not filecmp.cmp(target_path, entry):
                     shutil.copyfile(os.path.normpath(entry), target_path)
+                if copied is not None:
+                    copied[target_path] = entry
                 # update playlist
                 playlist.content[i] = target_path
 
@@ -639,16 +2059,21 @@ def relativate_playlists(abs_playlists: list, relative_to=OUTPUT_PLAYLIST_DIR_RE
        COPY Playlists to use relative paths 
     """
     rel_playlists = []
+    pl_lines = {} # the same file is often in many playlists, so each path is only converted once
     for abs_playlist in abs_playlists:
         rel_playlist = Playlist(name=abs_playlist.name)
         rel_playlists.append(rel_playlist)
         rel_playlist.content = []
         for abspath in abs_playlist.content:
+            pl_line = pl_lines.get(abspath)
+            if pl_line is not None:
+                rel_playlist.content.append(pl_line)
+                continue
             try:
                 # create relative path. This could fail.
                 relpath = os.path.relpath(abspath, start=relative_to)
                 # transform to forward slashes
-                pl_line = relpath.replace('\\', '/')
+                pl_line = pl_lines[abspath] = relpath.replace('\\', '/')
                 rel_playlist.content.append(pl_line)
             except ValueError as ve:
                 # target is probably on a different drive.
@@ -660,52 +2085,511 @@ def relativate_playlists(abs_playlists: list, relative_to=OUTPUT_PLAYLIST_DIR_RE
 def debug_create_lmfi_sans_tags():
     return [FileInfo(filename=filpath, full_path=os.path.abspath(os.path.join(dirpath, filpath))) for (dirpath, _dirs, filpaths) in os.walk(MUSIC_PATH) for filpath in filpaths if not is_ignored(dirpath) ]
 
+class HashStore:
+    """
+        Persistent storage of file content hashes, keyed by path and hash algorithm.
+        An entry is only used while the file still has the same size, mtime and inode, so unchanged files are never hashed again.
+        Hashes of different algorithms are stored side by side and never mixed up.
+    """
+    def __init__(self, db_path=CACHE_DB_PATH):
+        self.db = open_cache_db(db_path)
+        ensure_cache_table(self.db, "hashes", ["path TEXT", "algorithm TEXT", "size INTEGER", "mtime_ns INTEGER", "inode INTEGER", "hash TEXT", "PRIMARY KEY (path, algorithm)"])
+        self.entries = { (row[0], row[1]): row[2:] for row in self.db.execute("SELECT path, algorithm, size, mtime_ns, inode, hash FROM hashes") }
+
+    @staticmethod
+    def signature(path):
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def get(self, path, algorithm=None):
+        """
+            Returns the stored hash if the file did not change since it was stored, None otherwise.
+        """
+        entry = self.entries.get((path, algorithm or HASH_ALGORITHM))
+        if entry is None:
+            return None
+        try:
+            if tuple(entry[:3]) != HashStore.signature(path):
+                return None
+        except OSError:
+            return None
+        return entry[3]
+
+    def put(self, path, filehash, signature=None, algorithm=None):
+        """
+            signature should be taken before the file was read, so that a file modified while hashing is not trusted later.
+        """
+        algorithm = algorithm or HASH_ALGORITHM
+        if signature is None:
+            signature = HashStore.signature(path)
+        self.entries[(path, algorithm)] = tuple(signature) + (filehash,)
+        self.db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)", (path, algorithm) + self.entries[(path, algorithm)])
+
+    def forget(self, paths):
+        """
+            Removes the entries of the paths, for all algorithms.
+        """
+        paths = set(paths)
+        for key in [key for key in self.entries if key[0] in paths]:
+            del self.entries[key]
+        for path in paths:
+            self.db.execute("DELETE FROM hashes WHERE path = ?", (path,))
+
+    def prune(self):
+        """
+            Removes the entries of files that no longer exist. Returns how many files were removed.
+        """
+        gone = { path for (path, _algorithm) in self.entries if not os.path.exists(path) }
+        self.forget(gone)
+        self.db.commit()
+        return len(gone)
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
 @dataclass
 class HashCacheSingleton:
-    filehashes={}
+    filehashes={} # maps (algorithm, path) to the hash
+    store=None # a HashStore, if hashes should be remembered between runs
+
+def syncsafe_int(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+def audio_payload_range(f, size):
+    """
+        Returns (start, end) of the audio data in the opened file, without the ID3v2 tags and FLAC metadata blocks
+        at the start and the ID3v1 and APE tags at the end. Only the headers are read.
+        Other formats keep their metadata inline, so for them this is just the whole file minus those tags.
+    """
+    start = 0
+    # ID3v2, possibly several of them
+    while True:
+        f.seek(start)
+        header = f.read(10)
+        if len(header) < 10 or header[:3] != b"ID3":
+            break
+        start += 10 + syncsafe_int(header[6:10]) + (10 if header[5] & 0x10 else 0) # footer present flag
+    # FLAC metadata blocks
+    f.seek(start)
+    if f.read(4) == b"fLaC":
+        start += 4
+        while start < size:
+            f.seek(start)
+            block_header = f.read(4)
+            if len(block_header) < 4:
+                break
+            start += 4 + int.from_bytes(block_header[1:4], "big")
+            if block_header[0] & 0x80: # last metadata block
+                break
+    end = size
+    while end > start:
+        # ID3v1 and APEv2 at the end, in either order
+        f.seek(max(start, end - 128))
+        tail = f.read(end - max(start, end - 128))
+        if len(tail) == 128 and tail[:3] == b"TAG":
+            end -= 128
+            continue
+        if len(tail) >= 32 and tail[-32:-24] == b"APETAGEX":
+            footer = tail[-32:]
+            ape_size = int.from_bytes(footer[12:16], "little") + (32 if int.from_bytes(footer[20:24], "little") & 0x80000000 else 0)
+            end -= ape_size
+            continue
+        break
+    return (min(start, size), max(min(start, size), end))
+
+def hash_kind(algorithm=HASH_ALGORITHM, audio_only=HASH_AUDIO_ONLY):
+    """
+        The name under which hashes are cached. Hashes of the audio data only are never mixed with hashes of whole files.
+    """
+    return "{}+audio".format(algorithm) if audio_only else algorithm
 
-def hash_file_md5(filepath, BUF_SIZE=2*65536):
+def digest_file(filepath, algorithm=HASH_ALGORITHM, audio_only=False, BUF_SIZE=2*65536):
     """
-        BUF_SIZE is arbitrarily chosen to read files in 128kb chunks.
+        Computes the hexdigest of the whole file without loading it into memory at once.
+        If audio_only, the tags are skipped, so retagged copies of the same file get the same hash.
+        hashlib releases the GIL while hashing, so this can run in several threads at once.
     """
-    # check cache
-    cc = HashCacheSingleton.filehashes.get(filepath, None)
+    with open(os.path.normpath(filepath), 'rb') as f:
+        if audio_only:
+            start, end = audio_payload_range(f, os.fstat(f.fileno()).st_size)
+            h = hashlib.new(algorithm)
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                data = f.read(min(BUF_SIZE, remaining))
+                if not data:
+                    break
+                h.update(data)
+                remaining -= len(data)
+            return h.hexdigest()
+        if hasattr(hashlib, "file_digest"):
+            # python 3.11+ reads straight into the hash without python-level chunking
+            return hashlib.file_digest(f, algorithm).hexdigest()
+        h = hashlib.new(algorithm)
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+                return h.hexdigest()
+        except (ValueError, OSError):
+            # empty files and some network drives can't be mapped. BUF_SIZE is arbitrarily chosen to read files in 128kb chunks.
+            while True:
+                data = f.read(BUF_SIZE)
+                if not data:
+                    break
+                h.update(data)
+        return h.hexdigest()
+
+def cached_hash(filepath, algorithm=HASH_ALGORITHM):
+    """
+        Returns the hash of the file if it is known from this run or from the HashStore, None otherwise.
+    """
+    cc = HashCacheSingleton.filehashes.get((algorithm, filepath), None)
     if cc:
         return cc
-
-    # compute md5 without reading the whole file at once. Maybe not necessary, but whatever.
-    md5=hashlib.md5()
+    if HashCacheSingleton.store is not None:
+        cc = HashCacheSingleton.store.get(filepath, algorithm=algorithm)
+        if cc:
+            HashCacheSingleton.filehashes[(algorithm, filepath)] = cc
+            return cc
+    return None
+
+def hash_files(filepaths, algorithm=HASH_ALGORITHM, workers=HASH_WORKERS, audio_only=HASH_AUDIO_ONLY):
+    """
+        Returns the hashes of the files in the same order. Unknown files are hashed by a pool of worker threads.
+    """
+    filepaths = list(filepaths)
+    kind = hash_kind(algorithm, audio_only)
+    hashes = [cached_hash(filepath, kind) for filepath in filepaths]
+    missing = [i for i, h in enumerate(hashes) if h is None]
+    # take the signature before reading, so that a file modified while hashing is not trusted later
+    signatures = [HashStore.signature(filepaths[i]) if HashCacheSingleton.store is not None else None for i in missing]
+    computed = map_with_workers(lambda filepath: digest_file(filepath, algorithm, audio_only=audio_only), [filepaths[i] for i in missing],
+            workers=workers, progress_label="HASHING")
+    for i, signature, filehash in zip(missing, signatures, computed):
+        hashes[i] = filehash
+        # the cache is only written from this thread, sqlite connections must not be shared
+        HashCacheSingleton.filehashes[(kind, filepaths[i])] = filehash
+        if HashCacheSingleton.store is not None:
+            HashCacheSingleton.store.put(filepaths[i], filehash, signature, algorithm=kind)
+    return hashes
+
+def hash_file(filepath, algorithm=HASH_ALGORITHM, audio_only=HASH_AUDIO_ONLY):
+    return hash_files([filepath], algorithm=algorithm, workers=1, audio_only=audio_only)[0]
+
+def hash_file_md5(filepath):
+    return hash_file(filepath, algorithm="md5", audio_only=False)
+
+def hash_file_ends(filepath, start, end, chunk_size=DEDUP_PARTIAL_HASH_KIB*1024, algorithm=HASH_ALGORITHM):
+    """
+        Hashes only the first and the last chunk_size bytes of the range [start, end) of the file.
+        Files that differ in there can't be equal, so they don't need a full hash.
+    """
+    h=hashlib.new(algorithm)
     with open(os.path.normpath(filepath), 'rb') as f:
-        while True:
-            data = f.read(BUF_SIZE)
-            if not data:
-                break
-            md5.update(data)
-    mdhash = md5.hexdigest()
+        f.seek(start)
+        h.update(f.read(min(chunk_size, end - start)))
+        if end - start > 2*chunk_size:
+            f.seek(end - chunk_size)
+        h.update(f.read(min(chunk_size, end - f.tell())))
+    return h.hexdigest()
+
+def dedup_range(filepath, audio_only=HASH_AUDIO_ONLY):
+    """
+        The byte range [start, end) of the file that is compared for deduplication.
+    """
+    if not audio_only:
+        return (0, os.path.getsize(filepath))
+    with open(os.path.normpath(filepath), 'rb') as f:
+        return audio_payload_range(f, os.fstat(f.fileno()).st_size)
+
+def dedup_size(filepath, audio_only=HASH_AUDIO_ONLY):
+    """
+        The size that equal files must share: the file size, or the size of the audio data in audio_only mode.
+    """
+    start, end = dedup_range(filepath, audio_only)
+    return end - start
 
-    # cache
-    HashCacheSingleton.filehashes[filepath] = mdhash
+def candidate_duplicate_groups(paths, chunk_size=DEDUP_PARTIAL_HASH_KIB*1024, workers=HASH_WORKERS, audio_only=HASH_AUDIO_ONLY):
+    """
+        Returns lists of paths that might be equal files, in the order of paths. Files not in any list are unique.
+        Files are grouped by size first, and only files of the same size are compared by hash_file_ends.
+        If audio_only, the size and the partial hash are those of the audio data without the tags.
+    """
+    def safe_range(path):
+        try:
+            return dedup_range(path, audio_only)
+        except OSError as e:
+            print("INFO: Skipping file {} for deduplication: {}".format(path, e), file=sys.stderr)
+            return None
+    by_size = {}
+    # reading the tag headers in audio_only mode waits for the disk, so that runs in the pool as well
+    for path, byte_range in zip(paths, map_with_workers(safe_range, paths, workers=(workers if audio_only else 1))):
+        if byte_range is not None:
+            by_size.setdefault(byte_range[1] - byte_range[0], []).append((path, byte_range))
+    groups = []
+    to_compare = [] # (path, (start, end)) of files that need a partial hash
+    for size, same_size in by_size.items():
+        if len(same_size) < 2:
+            continue
+        if size <= 2*chunk_size:
+            # the partial hash would read the whole file anyway
+            groups.append([path for path, _byte_range in same_size])
+            continue
+        to_compare.extend(same_size)
+    ends = map_with_workers(lambda entry: hash_file_ends(entry[0], entry[1][0], entry[1][1], chunk_size),
+            to_compare, workers=workers, progress_label="PARTIAL HASHING")
+    by_ends = {}
+    for (path, byte_range), ends_hash in zip(to_compare, ends):
+        by_ends.setdefault((byte_range[1] - byte_range[0], ends_hash), []).append(path)
+    groups.extend(group for group in by_ends.values() if len(group) > 1)
+    # keep the original order of the files, as the first file in a redundancy list is the one that is kept
+    position = { path: i for i, path in enumerate(paths) }
+    return sorted(groups, key=lambda group: position[group[0]])
+
+def files_equal(a, b, audio_only=HASH_AUDIO_ONLY, BUF_SIZE=2*65536):
+    """
+        Byte for byte comparison, of the audio data only if audio_only.
+    """
+    if not audio_only:
+        return filecmp.cmp(a, b, shallow=False)
+    (a_start, a_end), (b_start, b_end) = dedup_range(a, True), dedup_range(b, True)
+    if a_end - a_start != b_end - b_start:
+        return False
+    with open(os.path.normpath(a), 'rb') as fa, open(os.path.normpath(b), 'rb') as fb:
+        fa.seek(a_start)
+        fb.seek(b_start)
+        remaining = a_end - a_start
+        while remaining > 0:
+            n = min(BUF_SIZE, remaining)
+            if fa.read(n) != fb.read(n):
+                return False
+            remaining -= n
+    return True
+
+# prefix of the keys of groups of near-duplicates in the redundancies, instead of a hash
+NEAR_DUPLICATE_PREFIX = "fingerprint:"
+
+def compute_fingerprint(path, fpcalc=FPCALC_PATH, seconds=FINGERPRINT_SECONDS):
+    """
+        Returns (duration in seconds, array of the raw 32 bit Chromaprint values) of the audio file, or None if fpcalc can't read it.
+    """
+    try:
+        result = subprocess.run([fpcalc, "-raw", "-length", str(seconds), path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
+    duration = None
+    fingerprint = None
+    for line in result.stdout.splitlines():
+        key, _sep, value = line.partition("=")
+        if key == "DURATION":
+            duration = float(value)
+        elif key == "FINGERPRINT":
+            # older versions of fpcalc print signed values
+            fingerprint = array.array('I', (int(v) & 0xFFFFFFFF for v in value.split(",") if v))
+    if duration is None or not fingerprint:
+        return None
+    return duration, fingerprint
+
+class FingerprintStore:
+    """
+        Persistent storage of the results of compute_fingerprint, keyed by path.
+        An entry is only used while the file still has the same size and mtime. Files fpcalc could not read are remembered too.
+    """
+    def __init__(self, db_path=CACHE_DB_PATH):
+        self.db = open_cache_db(db_path)
+        ensure_cache_table(self.db, "fingerprints", ["path TEXT PRIMARY KEY", "size INTEGER", "mtime_ns INTEGER", "duration REAL", "fingerprint BLOB"])
+        self.entries = { row[0]: row[1:] for row in self.db.execute("SELECT path, size, mtime_ns, duration, fingerprint FROM fingerprints") }
 
-    return mdhash
+    def get(self, path, signature):
+        """
+            Returns (True, result of compute_fingerprint) if the file is known unchanged, (False, None) otherwise.
+        """
+        entry = self.entries.get(path)
+        if entry is None or (entry[0], entry[1]) != signature:
+            return False, None
+        if entry[2] is None:
+            return True, None
+        return True, (entry[2], array.array('I', entry[3]))
+
+    def put(self, path, signature, result):
+        entry = (signature[0], signature[1], None if result is None else result[0], None if result is None else result[1].tobytes())
+        self.entries[path] = entry
+        self.db.execute("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?)", (path,) + entry)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+def fingerprint_files(paths, store: FingerprintStore = None, workers=HASH_WORKERS, fpcalc=FPCALC_PATH, seconds=FINGERPRINT_SECONDS):
+    """
+        Returns the results of compute_fingerprint for all paths, in the same order. Only files the store doesn't know are read.
+    """
+    results = [None] * len(paths)
+    to_compute = [] # (position, signature)
+    for i, path in enumerate(paths):
+        try:
+            signature = file_signature(path)
+        except OSError:
+            continue
+        known, result = store.get(path, signature) if store is not None else (False, None)
+        if known:
+            results[i] = result
+        else:
+            to_compute.append((i, signature))
+    computed = map_with_workers(lambda path: compute_fingerprint(path, fpcalc, seconds), [paths[i] for i, _signature in to_compute],
+            workers=workers, progress_label="FINGERPRINTS")
+    for (i, signature), result in zip(to_compute, computed):
+        results[i] = result
+        if store is not None:
+            store.put(paths[i], signature, result)
+    return results
+
+def fingerprint_similarity(a, b, min_overlap=20):
+    """
+        Share of equal bits of two fingerprints, aligned at the offset at which most of their values are equal.
+    """
+    positions = {}
+    for j, value in enumerate(b):
+        positions.setdefault(value, j)
+    offsets = collections.Counter(i - positions[value] for i, value in enumerate(a) if value in positions)
+    if not offsets:
+        return 0.0
+    offset = offsets.most_common(1)[0][0]
+    aligned = range(max(0, offset), min(len(a), len(b) + offset))
+    if len(aligned) < min_overlap:
+        return 0.0
+    errors = sum(bin(a[i] ^ b[i - offset]).count("1") for i in aligned)
+    return 1.0 - errors / (32.0 * len(aligned))
+
+class FingerprintIndex:
+    """
+        Finds the pairs of fingerprints that share many values, without comparing all pairs.
+        The same recording keeps many of its exact 32 bit values when encoded differently, so every value is a bucket.
+        Only the values whose hash falls into 1/sample_every of the range are indexed. The same values are sampled in every fingerprint,
+        so that equal values still meet in a bucket while the index stays small.
+    """
+    def __init__(self, fingerprints, sample_every=8, max_bucket_size=32):
+        buckets = {}
+        for number, fingerprint in enumerate(fingerprints):
+            if fingerprint is None:
+                continue
+            for value in set(fingerprint):
+                if ((value * 2654435761) & 0xFFFFFFFF) % sample_every == 0:
+                    buckets.setdefault(value, []).append(number)
+        # huge buckets are silence and the like, they say nothing about the song
+        self.buckets = [numbers for numbers in buckets.values() if 1 < len(numbers) <= max_bucket_size]
+
+    def candidate_pairs(self, min_shared=4):
+        shared = collections.Counter()
+        for numbers in self.buckets:
+            shared.update(itertools.combinations(numbers, 2))
+        return sorted(pair for pair, count in shared.items() if count >= min_shared)
+
+def near_duplicate_groups(paths, store: FingerprintStore = None, min_similarity=FINGERPRINT_MIN_SIMILARITY, max_duration_difference=10, workers=HASH_WORKERS, fpcalc=FPCALC_PATH):
+    """
+        Returns the groups of paths of files that contain the same song according to their fingerprints, as lists of at least two paths.
+    """
+    results = fingerprint_files(paths, store=store, workers=workers, fpcalc=fpcalc)
+    index = FingerprintIndex([None if result is None else result[1] for result in results])
+    parent = list(range(len(paths)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for a, b in index.candidate_pairs():
+        (duration_a, fingerprint_a), (duration_b, fingerprint_b) = results[a], results[b]
+        if abs(duration_a - duration_b) <= max_duration_difference and fingerprint_similarity(fingerprint_a, fingerprint_b) >= min_similarity:
+            parent[find(a)] = find(b)
+    groups = {}
+    for i, path in enumerate(paths):
+        groups.setdefault(find(i), []).append(path)
+    return [group for group in groups.values() if len(group) > 1]
+
+LOSSLESS_CODECS = {'flac', 'alac', 'wave', 'aiff', 'monkeysaudio', 'wavpack', 'trueaudio', 'optimfrog', 'dsf', 'dsdiff'}
+
+# what the parts of duplicate_rank_key stand for, for the report
+DUPLICATE_RANK_REASONS = ["lossless", "higher bitrate", "longer", "not in DEDUP_AVOID_FOLDERS", "more complete tags", "shorter path", "first path alphabetically"]
+
+def duplicate_rank_key(file_info, avoid_folders=DEDUP_AVOID_FOLDERS):
+    """
+        Sorting key for redundant files, the file to keep comes first. Only uses the cached AudioInfo and FileTag.
+    """
+    audio_info = file_info.get_audio_info()
+    tag = file_info.tag
+    return (audio_info.codec not in LOSSLESS_CODECS,
+            -audio_info.bitrate,
+            -round(audio_info.length),
+            any(path_a_in_b(file_info.full_path, avoided) for avoided in avoid_folders),
+            -(0 if tag is None else sum(1 for part in (tag.artist, tag.album, tag.title) if part)),
+            len(file_info.full_path),
+            file_info.full_path)
+
+def rank_redundancies(redundancies, file_infos_by_path, avoid_folders=DEDUP_AVOID_FOLDERS):
+    """
+        Returns the redundancies with the file to keep first in each list, and a report of what was kept and why.
+    """
+    ranked = {}
+    report = []
+    for mdhash, redlist in redundancies.items():
+        file_infos = [file_infos_by_path.get(path) or FileInfo(full_path=path, filename=os.path.basename(path)) for path in redlist]
+        keyed = sorted(((duplicate_rank_key(file_info, avoid_folders), file_info) for file_info in file_infos), key=lambda x: x[0])
+        ranked[mdhash] = [file_info.full_path for _key, file_info in keyed]
+        # the reason is the first part of the key in which the kept file is better than the next one
+        reason = next(DUPLICATE_RANK_REASONS[i] for i, (a, b) in enumerate(zip(keyed[0][0], keyed[1][0])) if a != b) if len(keyed) > 1 else None
+        report.append({
+            "kept": keyed[0][1].full_path,
+            "reason": reason,
+            "files": [{"path": file_info.full_path, "codec": file_info.audio_info.codec, "bitrate": file_info.audio_info.bitrate,
+                "length": file_info.audio_info.length, "sample_rate": file_info.audio_info.sample_rate} for _key, file_info in keyed],
+            })
+    return ranked, report
+
+def load_audio_infos(file_infos, tag_cache: TagCache = None):
+    """
+        Makes sure the FileInfos have their AudioInfo, from the tag cache if one is given and knows the file.
+    """
+    unknown = [file_info for file_info in file_infos if file_info.audio_info is None]
+    if unknown:
+        update_tags_from_fs(unknown, tag_cache=tag_cache, workers=TAG_INDEX_WORKERS, use_processes=TAG_INDEX_USE_PROCESSES)
 
-def compute_redundant_files(local_music_file_infos, folder=MUSIC_PATH):
+def compute_redundant_files(local_music_file_infos, folder=MUSIC_PATH, tiered=DEDUP_TIERED, audio_only=HASH_AUDIO_ONLY, avoid_folders=DEDUP_AVOID_FOLDERS, fingerprints=DEDUP_FINGERPRINTS, tag_cache: TagCache = None):
     """
         The files aren't that big, so we wouldn't need to compute a hash for comparison... but since we need one for tracking... we compute one. Then if the hashes match up, we can do a quick comparison.
 
         You are supposed to keep one of the files - only the others are redundant.
+
+        If tiered, only files that share their size and the hash of their first and last few KiB with another file are fully hashed.
+        The result is the same, as the files that are not hashed can't be redundant.
+
+        If audio_only, files count as redundant if their audio data is equal, even if their tags differ.
+
+        The first file of each list is the one to keep, see duplicate_rank_key. The stream info it needs is taken from the tag_cache if one is given.
+
+        If fingerprints, files that contain the same song but not the same data are grouped as well. Their keys start with NEAR_DUPLICATE_PREFIX
+        and their lists hold the kept file of each group of equal files, or files that are not equal to any other.
     """
     startTime=datetime.now()
+    if USE_HASH_STORE and HashCacheSingleton.store is None:
+        HashCacheSingleton.store = HashStore(db_path=CACHE_DB_PATH)
     redundancies = {} # maps hexdigest of hash to list of file paths
-    progressctr=0
-    progresstotal=len(local_music_file_infos)
+    if tiered:
+        # only files that share size and partial hash with another file are fully hashed
+        paths_to_hash = [path for group in candidate_duplicate_groups([lmfi.full_path for lmfi in local_music_file_infos], audio_only=audio_only) for path in group]
+    else:
+        paths_to_hash = [lmfi.full_path for lmfi in local_music_file_infos]
     # See https://stackoverflow.com/questions/22058048/hashing-a-file-in-python
-    for lmfi in local_music_file_infos:
-        progressctr+=1
-        if progressctr % 200 == 0:
-            print("[HASHING]: Progress {} / {}".format(progressctr, progresstotal))
-        mdhash=hash_file_md5(lmfi.full_path)
+    for path, mdhash in zip(paths_to_hash, hash_files(paths_to_hash, audio_only=audio_only)):
         # add to dict
-        redundancies[mdhash] = redundancies.get(mdhash, list()) + [lmfi.full_path]
+        redundancies.setdefault(mdhash, []).append(path)
+    if HashCacheSingleton.store is not None:
+        HashCacheSingleton.store.commit()
     
     if I_AM_SCARED_OF_HASH_COLLISIONS:
         # make sure they really are equal, byte for byte. If we're unsure, we better treat them as distinct
@@ -728,7 +2612,7 @@ def compute_redundant_files(local_music_file_infos, folder=MUSIC_PATH):
                     # I don't even
                     break
                 # the nontrivial case
-                eq_to_first = [filecmp.cmp(pathlist[0], pathlist[i]) for i in range(1, len(pathlist))]
+                eq_to_first = [files_equal(pathlist[0], pathlist[i], audio_only=audio_only) for i in range(1, len(pathlist))]
                 try:
                     num_the_same = sum(eq_to_first)
                 except IndexError as e:
@@ -771,34 +2655,65 @@ def compute_redundant_files(local_music_file_infos, folder=MUSIC_PATH):
         if len(val) > 1:
             redundancies[key]=val
 
+    # rank by the cached stream info. Files whose tags were never read are looked up in the tag cache, if there is one.
+    file_infos_by_path = { lmfi.full_path: lmfi for lmfi in local_music_file_infos }
+    load_audio_infos([file_infos_by_path[path] for redlist in redundancies.values() for path in redlist if path in file_infos_by_path], tag_cache=tag_cache)
+    redundancies, report = rank_redundancies(redundancies, file_infos_by_path, avoid_folders=avoid_folders)
+
+    if fingerprints and shutil.which(FPCALC_PATH) is None:
+        print("WARNING: {} not found, so near-duplicates are not searched. Get it from https://acoustid.org/chromaprint".format(FPCALC_PATH), file=sys.stderr)
+    elif fingerprints:
+        # one file of each group of equal files is enough
+        redundant = { path for redlist in redundancies.values() for path in redlist[1:] }
+        paths = [lmfi.full_path for lmfi in local_music_file_infos if lmfi.full_path not in redundant and looks_like_audio_file(lmfi.full_path)]
+        store = FingerprintStore(db_path=CACHE_DB_PATH)
+        groups = near_duplicate_groups(paths, store=store, min_similarity=FINGERPRINT_MIN_SIMILARITY, workers=HASH_WORKERS, fpcalc=FPCALC_PATH)
+        store.close()
+        print("Found {} groups of near-duplicates.".format(len(groups)))
+        load_audio_infos([file_infos_by_path[path] for group in groups for path in group], tag_cache=tag_cache)
+        near_redundancies, near_report = rank_redundancies({ "{}{}".format(NEAR_DUPLICATE_PREFIX, i): group for i, group in enumerate(groups) },
+                file_infos_by_path, avoid_folders=avoid_folders)
+        redundancies.update(near_redundancies)
+        report.extend(near_report)
 
     print("Time: {}".format(datetime.now() - startTime))
     if DUMP_REDUNDANCIES_AS_JSON_TO_OUTPUT_PLAYLIST_DIR:
         with open(os.path.join(OUTPUT_PLAYLIST_DIR, "redundancies.json"), "w", encoding="utf-8") as jsf:
             json.dump(redundancies, jsf, indent=4)
+        with open(os.path.join(OUTPUT_PLAYLIST_DIR, "redundancies_report.json"), "w", encoding="utf-8") as jsf:
+            json.dump(report, jsf, indent=4)
 
     return redundancies
 
-def update_playlists(playlists, redundancies):
+def update_playlists(playlists, redundancies, audio_only=HASH_AUDIO_ONLY):
     """
-        Compute new Playlists that all use the same songs.
+        Make the Playlists all use the same songs, i.e. the first path in each list of redundancies.
+        Modifies the Playlists!
     """
+    # near-duplicates last, so that the kept file of a group of equal files points to the kept near-duplicate
+    groups = sorted(redundancies.items(), key=lambda item: item[0].startswith(NEAR_DUPLICATE_PREFIX))
+    kept_paths = { path: redlist[0] for _key, redlist in groups for path in redlist }
+    # files that were not part of the redundancy computation (e.g. copied fallbacks) can only be redundant if their size matches
+    redundant_sizes = { dedup_size(redlist[0], audio_only) for redlist in redundancies.values() if os.path.exists(redlist[0]) }
     for playlist in playlists:
-        name=playlist.name
-        pl=Playlist(name=name)
-        for songpath in playlist.content:
-            mdhash = hash_file_md5(songpath) 
-            p = redundancies.get(mdhash, [None])[0] or songpath
-            pl.add(p)
+        for i, songpath in enumerate(playlist.get_content()):
+            p = kept_paths.get(songpath)
+            if p is None and os.path.isfile(songpath) and dedup_size(songpath, audio_only) in redundant_sizes:
+                mdhash = hash_file(songpath, audio_only=audio_only)
+                p = redundancies.get(mdhash, [None])[0]
+            while p is not None and kept_paths.get(p, p) != p:
+                p = kept_paths[p]
+            playlist.content[i] = p or songpath
     return playlists
 
-def delete_redundant_files(redundancies, folder=MUSIC_PATH, move_instead_of_delete=MOVE_FILES_INSTEAD_OF_DELETION):
+def delete_redundant_files(redundancies, folder=MUSIC_PATH, move_instead_of_delete=MOVE_FILES_INSTEAD_OF_DELETION, delete_near_duplicates=DELETE_NEAR_DUPLICATES):
     """
         delete all that are not the first in their list and that are within the music path
 
         redundancies: a dict of { hash string : list of paths }
         folder: folder to delete within
         move_instead_of_delete: a trash bin path or a falsy value
+        delete_near_duplicates: whether the groups found by fingerprints are deleted too, not just files with equal hashes
     """
     verb="Deleted"
     if move_instead_of_delete: 
@@ -807,6 +2722,8 @@ def delete_redundant_files(redundancies, folder=MUSIC_PATH, move_instead_of_dele
 
     counter=0
     for mdhash, redlist in redundancies.items():
+        if mdhash.startswith(NEAR_DUPLICATE_PREFIX) and not delete_near_duplicates:
+            continue
         for entry in redlist[1:]:
             counter+=1
             if move_instead_of_delete: 
@@ -814,9 +2731,208 @@ def delete_redundant_files(redundancies, folder=MUSIC_PATH, move_instead_of_dele
                 shutil.move(os.path.normpath(entry), os.path.join(move_instead_of_delete, os.path.basename(entry)))
             else:
                 os.remove(os.path.normpath(entry))
-    pass
+        if HashCacheSingleton.store is not None:
+            HashCacheSingleton.store.forget(redlist[1:])
+    if HashCacheSingleton.store is not None:
+        HashCacheSingleton.store.commit()
     print("{verbd} {n} files.".format(verbd=verb, n=counter))
 
+@dataclass
+class MatchContext:
+    """
+        Everything the matchers need to know about the library. Only read while matching.
+    """
+    local_music_file_infos: list
+    local_tag_index: TagIndex
+    local_contains_index: ContainsIndex
+    fallback_index: FallbackIndex
+    local_filename_engine: SimilarityEngine = None
+    local_tag_engine: SimilarityEngine = None
+
+@dataclass(frozen=True)
+class MatchDecision:
+    """
+        The outcome of matching one song, so that it can be replayed into MatchTrackers without matching again.
+        song_info is the song as it was matched, i.e. with the stripped title if only that matched.
+        path is None if the song is unmatched.
+    """
+    song_info: SongInfo
+    path: str
+    match_source: MatchSource
+    from_fallback: bool = False
+    fuzzy_info: str = None
+
+class DecisionRecorder:
+    """
+        Stands in for a MatchTracker while matching and remembers the match instead of counting it.
+    """
+    def __init__(self, from_fallback=False):
+        self.from_fallback = from_fallback
+        self.decision = None
+
+    def match(self, songinfo, path, match_source: MatchSource, playlist: Playlist, fuzzy_info: str = None):
+        self.decision = MatchDecision(song_info=songinfo, path=path, match_source=match_source, from_fallback=self.from_fallback, fuzzy_info=fuzzy_info)
+
+class MatchStore:
+    """
+        Persistent storage of the MatchDecisions of previous runs, keyed by the song as it is written in the placeholders.
+        A decision is only used while its file still exists. Unmatched songs are not stored, so they are matched again in every run.
+    """
+    def __init__(self, db_path=CACHE_DB_PATH, rebuild=REBUILD_MATCH_STORE):
+        self.db = open_cache_db(db_path)
+        ensure_cache_table(self.db, "matches", ["song TEXT PRIMARY KEY", "path TEXT", "match_source TEXT", "from_fallback INTEGER", "fuzzy_info TEXT", "swapped_titles INTEGER"], rebuild=rebuild)
+        self.entries = { row[0]: row[1:] for row in self.db.execute("SELECT song, path, match_source, from_fallback, fuzzy_info, swapped_titles FROM matches") }
+        self.hits = 0
+
+    @staticmethod
+    def key_of(song_info):
+        # the same as in the placeholders, so that paths specified by the user can be stored as well
+        return pformat(song_info)
+
+    def get(self, song_info):
+        """
+            Returns the stored MatchDecision for the song if its file still exists, None otherwise.
+        """
+        entry = self.entries.get(MatchStore.key_of(song_info))
+        if entry is None:
+            return None
+        path, match_source, from_fallback, fuzzy_info, swapped_titles = entry
+        if not os.path.isfile(path):
+            return None
+        self.hits += 1
+        return MatchDecision(song_info=song_info.with_swapped_titles() if swapped_titles else song_info, path=path,
+                match_source=MatchSource[match_source], from_fallback=bool(from_fallback), fuzzy_info=fuzzy_info)
+
+    def put(self, song_info, decision: MatchDecision):
+        if decision.path is None:
+            return
+        self._put(MatchStore.key_of(song_info), (decision.path, decision.match_source.name, decision.from_fallback, decision.fuzzy_info, decision.song_info != song_info))
+
+    def put_user_specified(self, key, path):
+        """
+            Stores a path the user specified for the placeholder key.
+        """
+        self._put(key, (path, MatchSource.USER_SPECIFIED.name, False, None, False))
+
+    def _put(self, key, entry):
+        self.entries[key] = entry
+        self.db.execute("INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?, ?)", (key,) + entry)
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+def build_match_context(local_music_file_infos, fallback_index, tag_cache: TagCache = None):
+    """
+        Reads the tags that were not read yet and builds the indices of the MatchContext.
+        fallback_index is a FallbackIndex, or a list of FileInfos that are all from the same root.
+    """
+    if not isinstance(fallback_index, FallbackIndex):
+        fallback_index = FallbackIndex([None], [fallback_index])
+    local_music_file_infos = as_library(local_music_file_infos)
+    print("Indexing music file tags...")
+    update_tags_from_fs([file_info for file_info in itertools.chain(local_music_file_infos, fallback_index.file_infos) if not file_info.is_tag_loaded()],
+            tag_cache=tag_cache, workers=TAG_INDEX_WORKERS, use_processes=TAG_INDEX_USE_PROCESSES)
+    print("Building tag indices...")
+    local_filename_engine = None
+    local_tag_engine = None
+    if USE_UNRELIABLE_METHODS:
+        local_filename_engine = fuzzy_filename_engine(local_music_file_infos)
+        local_tag_engine = fuzzy_tag_engine(local_music_file_infos)
+    fallback_index.build_lookups()
+    return MatchContext(
+            local_music_file_infos=local_music_file_infos, local_tag_index=TagIndex(local_music_file_infos), local_contains_index=ContainsIndex(local_music_file_infos),
+            fallback_index=fallback_index,
+            local_filename_engine=local_filename_engine, local_tag_engine=local_tag_engine)
+
+def resolve_song(song_info, context: MatchContext):
+    """
+        Runs all matching methods on the song and returns the MatchDecision. Does not modify any tracker or playlist.
+    """
+    recorder = DecisionRecorder()
+    fallback_recorder = DecisionRecorder(from_fallback=True)
+    # try once normally, and if nothing works try again with the stripped title
+    for hack_one in range(2):
+        # hack_one: use stripped title as normal title
+        if (hack_one == 1):
+            song_info = song_info.with_swapped_titles()
+
+        # try exact tag matching - for MP3 files only
+        if find_exact_tag_match(context.local_music_file_infos, song_info, recorder, playlist=None, tag_index=context.local_tag_index):
+            return recorder.decision
+
+        # try a simple heuristic of whether the tags contain the relevant title and artist
+        if tags_contain_info(context.local_music_file_infos, song_info, recorder, playlist=None, contains_index=context.local_contains_index):
+            return recorder.decision
+
+        # try a heuristic on the file path (full path, not just name)
+        if filepath_contains_info(context.local_music_file_infos, song_info, recorder, playlist=None, contains_index=context.local_contains_index):
+            return recorder.decision
+
+        # Not found... let's use the fallback GPM export (if set)
+        # Since the Tags should be correct there, we only check for exact matches. But technically we could also run the other checks.
+        if find_exact_tag_match(context.fallback_index.file_infos, song_info, fallback_recorder, playlist=None, tag_index=context.fallback_index.tag_index):
+            return fallback_recorder.decision
+        # But since gpm seems to cut off some parts of long titles, let's also check for substrings
+        if find_substring_tag_match(context.fallback_index.file_infos, song_info, fallback_recorder, playlist=None, fallback_index=context.fallback_index):
+            return fallback_recorder.decision
+
+        # try things that are likely to guess wrongly
+        if USE_UNRELIABLE_METHODS:
+            # try fuzzy filename matching in various orders
+            fuzzy_match_techniques = [
+                    "{artist}{title}{album}",
+                    "{artist}{title}",
+                    "{artist}{album}{title}",
+                    "{title}",
+                    "{title} - {artist}",
+                    ]
+            for tec in fuzzy_match_techniques:
+                if find_fuzzy_match(context.local_music_file_infos, song_info, tec, recorder, playlist=None, engine=context.local_filename_engine):
+                    return recorder.decision
+
+            # try fuzzy tag matching
+            if find_fuzzy_tag_match(context.local_music_file_infos, song_info, recorder, playlist=None, engine=context.local_tag_engine):
+                return recorder.decision
+
+    # no match has been found for this song.
+    return MatchDecision(song_info=None, path=None, match_source=MatchSource.UNMATCHED)
+
+# The MatchContext of the running resolve_songs. Forked workers inherit it, so the indices are shared copy-on-write instead of pickled.
+_WORKER_MATCH_CONTEXT = None
+
+def resolve_song_in_worker(song_info):
+    return resolve_song(song_info, _WORKER_MATCH_CONTEXT)
+
+def resolve_songs(song_infos, context: MatchContext, workers=MATCH_WORKERS):
+    """
+        Returns the MatchDecisions of all songs in the same order, like calling resolve_song on each of them.
+        The songs are matched by a pool of forked processes if possible, otherwise one after another.
+    """
+    global _WORKER_MATCH_CONTEXT
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        workers = 1
+    _WORKER_MATCH_CONTEXT = context
+    try:
+        return list(map_with_workers(resolve_song_in_worker, song_infos, workers=workers, use_processes=True,
+            progress_label="MATCH", mp_context=multiprocessing.get_context('fork') if workers > 1 else None))
+    finally:
+        _WORKER_MATCH_CONTEXT = None
+
+def apply_decision(decision: MatchDecision, song_info, tracker: MatchTracker, fallback_tracker: MatchTracker, playlist: Playlist, playlistname):
+    """
+        Counts the decision for song_info in the trackers and adds it to the playlist, just as if the song had been matched right now.
+    """
+    if decision.path is None:
+        tracker.unmatch(song_info, playlist)
+        tracker.unmatch_for_playlist(playlistname)
+        return
+    matched_tracker = fallback_tracker if decision.from_fallback else tracker
+    matched_tracker.match(decision.song_info, decision.path, decision.match_source, playlist=playlist, fuzzy_info=decision.fuzzy_info)
+
 def main():
     startTime=datetime.now()
     tracker = MatchTracker()
@@ -824,135 +2940,62 @@ def main():
     print("Considering any playlists in {}".format(PLAYLISTS_PATH))
     
     print("Collecting playlist directories...\n")
-    subfolders = [ f.path for f in os.scandir(PLAYLISTS_PATH) if f.is_dir() and not is_ignored(f.path) ]
-    playlists = list(filter_playlists(subfolders))
-    for playlistpath in playlists:
-        playlistname = os.path.basename(playlistpath)
-        print("\tPlaylist: {}".format(playlistname))
+    songlists = read_takeout(PLAYLISTS_PATH, use_store=USE_TAKEOUT_STORE, db_path=CACHE_DB_PATH, workers=TAKEOUT_READ_WORKERS) # (playlist name, list of SongInfo)
+    for playlistname, song_info_list_sorted in songlists:
+        print("\tPlaylist: {} ({} songs)".format(playlistname, len(song_info_list_sorted)))
 
     print("Indexing local music files...")
-    local_music_file_infos = [FileInfo(filename=filpath, full_path=os.path.abspath(os.path.join(dirpath, filpath))) for (dirpath, _dirs, filpaths) in os.walk(MUSIC_PATH) for filpath in filpaths if not is_ignored(dirpath) ]
-
-    print("Indexing local music file tags...")
-    for file_info in local_music_file_infos:
-        file_info.update_tag_from_fs()
+    dir_index = DirectoryIndex(db_path=CACHE_DB_PATH, rebuild=REBUILD_DIRECTORY_INDEX) if USE_DIRECTORY_INDEX else None
+    local_music_paths = (os.path.abspath(path) for path in walk_files(MUSIC_PATH, dir_index=dir_index))
+    if COMPACT_LIBRARY_INDEX:
+        local_music_file_infos = LibraryIndex.from_paths(local_music_paths)
+    else:
+        local_music_file_infos = [FileInfo(filename=os.path.basename(path), full_path=path) for path in local_music_paths ]
+    # The tags are only read if some song needs to be matched
 
     print("Indexing fallback...") 
-    fallback_music_file_infos = []
-    fallback_music_files=[]
-    for fallback in GPM_FALLBACK_TRACK_PATHS:
-        fbpath = os.path.normpath(fallback)
-
-        print("Indexing local fallback music files for {} ...".format(fbpath))
-        fallback_music_file_infos = [FileInfo(filename=filpath, full_path=os.path.join(dirpath, filpath)) for (dirpath, _dirs, filpaths) in os.walk(fbpath) for filpath in filpaths if not is_ignored(dirpath) ]
-        fallback_music_files=map(lambda x: x.get_plain_filename(), fallback_music_file_infos)
-
-        print("Indexing local fallback music tags for {} ...".format(fbpath))
-        for file_info in fallback_music_file_infos:
-            file_info.update_tag_from_fs()
-
+    # All roots are searchable, earlier roots first
+    fallback_index = FallbackIndex.from_roots(GPM_FALLBACK_TRACK_PATHS, dir_index=dir_index, workers=FALLBACK_INDEX_WORKERS, compact=COMPACT_LIBRARY_INDEX)
+    for fbpath, count in fallback_index.files_per_root().items():
+        print("\tIndexed {} local fallback music files in {}".format(count, fbpath))
+    if dir_index is not None:
+        dir_index.prune()
+        print("Directory index: {} folders listed, {} unchanged".format(dir_index.listed, dir_index.reused))
+        dir_index.close()
+
+    match_store = MatchStore(db_path=CACHE_DB_PATH, rebuild=REBUILD_MATCH_STORE) if USE_MATCH_STORE else None
     output_playlists = [] # List of Playlist objects
 
     print("Accumulating Contents...")
-    # hackaround for Thumbs up Playlist: add it and handle it separately
-    THUMBSUPHACK="thumbsuphack1234542323232321231233333$2"
-    playlists.append(THUMBSUPHACK)
-    for playlistpath in playlists:
-        if playlistpath != THUMBSUPHACK:
-            playlistname = os.path.basename(playlistpath)
-            print("Accumulating Contents for Playlist {}".format(playlistname))
-            song_info_list_sorted = read_gpm_playlist(playlistpath)
-        else:
-            playlistname = "Thumbs up"
-            print("Accumulating Contents for Playlist {}".format(playlistname))
-            song_info_list_sorted = read_gpm_playlist(PLAYLISTS_PATH, trackdir="Thumbs up")
-        song_path_list = []
+    # The same song is often in several playlists, e.g. in Thumbs up and others. Its match only needs to be found once.
+    all_song_infos = [song_info for _playlistname, song_infos in songlists for song_info in song_infos]
+    song_infos_to_match = list(dict.fromkeys(all_song_infos)) if CACHE_MATCHES_ACROSS_PLAYLISTS else all_song_infos
+    decisions = [match_store.get(song_info) if match_store is not None else None for song_info in song_infos_to_match]
+    unresolved = [i for i, decision in enumerate(decisions) if decision is None]
+    if unresolved:
+        # The tags are only read and the indices only built if some song is not in the match store
+        tag_cache = TagCache(db_path=CACHE_DB_PATH, rebuild=REBUILD_TAG_CACHE) if USE_TAG_CACHE else None
+        match_context = build_match_context(local_music_file_infos, fallback_index, tag_cache=tag_cache)
+        if tag_cache is not None:
+            tag_cache.close()
+        print("Matching {} songs...".format(len(unresolved)))
+        for i, decision in zip(unresolved, resolve_songs([song_infos_to_match[i] for i in unresolved], match_context, workers=MATCH_WORKERS)):
+            decisions[i] = decision
+            if match_store is not None:
+                match_store.put(song_infos_to_match[i], decision)
+    if CACHE_MATCHES_ACROSS_PLAYLISTS:
+        decisions = map(dict(zip(song_infos_to_match, decisions)).__getitem__, all_song_infos)
+    decisions = iter(decisions)
+
+    # Count the matches in playlist order, exactly as if every song had been matched right there
+    for playlistname, song_info_list_sorted in songlists:
         # instantiate playlist object for later use
         playlist=Playlist(name=playlistname)
         output_playlists.append(playlist)
-        for song_info in song_info_list_sorted:
+        for song_info, decision in zip(song_info_list_sorted, decisions):
             # count number of playlist searches for debugging
             tracker.increment_search_counter(playlistname)
-
-            # try once normally, and if nothing works try again with the stripped title
-            match_found=False
-            for hack_one in range(2):
-                # hack_one: temporarily use stripped title as normal title
-                hack_one_tmp = None
-                if (hack_one == 1):
-                    hack_one_tmp = song_info
-                    song_info = SongInfo(
-                            title=song_info.title_stripped,
-                            artist=song_info.artist,
-                            album=song_info.album,
-                            title_stripped=song_info.title,
-                            liked=song_info.liked,
-                            )
-                    # restore at the end of loop iteration
-
-                # try exact tag matching - for MP3 files only
-                found_exact_match = find_exact_tag_match(local_music_file_infos, song_info, tracker, playlist=playlist)
-                if found_exact_match:
-                    match_found=True
-                    break
-
-                # try a simple heuristic of whether the tags contain the relevant title and artist
-                if tags_contain_info(local_music_file_infos, song_info, tracker, playlist=playlist):
-                    match_found=True
-                    break
-
-                # try a heuristic on the file path (full path, not just name)
-                if filepath_contains_info(local_music_file_infos, song_info, tracker, playlist=playlist):
-                    match_found=True
-                    break
-
-                # Not found... let's use the fallback GPM export (if set)
-                # Since the Tags should be correct there, we only check for exact matches. But technically we could also run the other checks.
-                found_exact_gpm_match = find_exact_tag_match(fallback_music_file_infos, song_info, fallback_tracker, playlist=playlist)
-                if found_exact_gpm_match:
-                    match_found=True
-                    break
-                # But since gpm seems to cut off some parts of long titles, let's also check for substrings
-                if find_substring_tag_match(fallback_music_file_infos, song_info, fallback_tracker, playlist=playlist):
-                    match_found=True
-                    break
-
-                # try things that are likely to guess wrongly
-                if USE_UNRELIABLE_METHODS:
-                    # try fuzzy filename matching in various orders
-                    fuzzy_match_techniques = [
-                            "{artist}{title}{album}",
-                            "{artist}{title}",
-                            "{artist}{album}{title}",
-                            "{title}",
-                            "{title} - {artist}",
-                            ]
-                    for tec in fuzzy_match_techniques:
-                        # if found, break and continue with next song
-                        found_fuzzy_match = find_fuzzy_match(local_music_file_infos, song_info, tec, tracker, playlist=playlist)
-                        if found_fuzzy_match:
-                            break
-                    if found_fuzzy_match:
-                        #continue with next song
-                        match_found=True
-                        break
-                    
-                    # try fuzzy tag matching
-                    found_fuzzy_tag_match = find_fuzzy_tag_match(local_music_file_infos, song_info, tracker, playlist=playlist)
-                    if found_fuzzy_tag_match:
-                        match_found=True
-                        break
-
-                if (hack_one == 1):
-                    # Not sure if this restoration is ever relevant, but why not do it.
-                    song_info = hack_one_tmp
-
-            if not match_found:
-                # if we're still here, no match has been found for this song.
-                tracker.unmatch(song_info, playlist)
-                tracker.unmatch_for_playlist(playlistname)
-            else:
-                continue # not explicitly needed
+            apply_decision(decision, song_info, tracker, fallback_tracker, playlist, playlistname)
 
     print("\nSubmatched Songs: \n{}\n#End List of Submatched Songs".format(pformat(fallback_tracker.subbed_songs)))
     print("\nUnmatched Songs: \n{}\n#End List of Unmatched Songs".format(pformat(tracker.unmatched_songs)))
@@ -961,23 +3004,53 @@ def main():
     print("\nMatches from Fallback (unmatched total is handled by other tracker):\n{}".format(pformat(fallback_tracker.match_counts)))
     print("\nSearched Playlists Statistics:\n{}".format(pformat(tracker.playlist_searches)))
     print("\nIncompleteness of Playlists (Number of missing Songs):\n{}".format(pformat(tracker.num_songs_missing)))
+    if match_store is not None:
+        print("Reused {} matches from previous runs.".format(match_store.hits))
+        match_store.commit()
     print("Time: {}".format(datetime.now() - startTime))
 
-    output_playlists=complete_playlists_interactively(output_playlists)
+    output_playlists=complete_playlists_interactively(output_playlists, match_store=match_store)
+    if match_store is not None:
+        match_store.close()
+    copied = {} # path of the copy: path of the fallback file
     if COPY_FALLBACK_GPM_MUSIC:
-        output_playlists=copy_files_over(output_playlists)
+        output_playlists=copy_files_over(output_playlists, copied=copied)
     if REDUCE_PLAYLIST_REDUNDANCIES:
-        redundancies = compute_redundant_files(local_music_file_infos, folder=MUSIC_PATH) # a dict of file hashes and a list of paths
+        dedup_file_infos = local_music_file_infos
+        if DEDUP_FINGERPRINTS:
+            # the copied fallbacks are not indexed yet, but they are the most likely near-duplicates
+            known_paths = { lmfi.full_path for lmfi in local_music_file_infos }
+            copied_paths = dict.fromkeys(path for playlist in output_playlists for path in playlist.get_content()
+                    if path not in known_paths and path_a_in_b(path, MUSIC_PATH) and os.path.isfile(path))
+            dedup_file_infos = list(local_music_file_infos) + [FileInfo(full_path=path, filename=os.path.basename(path)) for path in copied_paths]
+        tag_cache = TagCache(db_path=CACHE_DB_PATH, rebuild=False) if USE_TAG_CACHE else None
+        redundancies = compute_redundant_files(dedup_file_infos, folder=MUSIC_PATH, avoid_folders=DEDUP_AVOID_FOLDERS, fingerprints=DEDUP_FINGERPRINTS, tag_cache=tag_cache) # a dict of file hashes and a list of paths, the one to keep first
+        if tag_cache is not None:
+            tag_cache.close()
         output_playlists=update_playlists(output_playlists, redundancies) # only use the first file of each list
     else:
         redundancies = {}
     if DELETE_REDUNDANT_FILES_IN_MUSIC_PATH:
-        delete_redundant_files(redundancies, folder=MUSIC_PATH) # delete all that are not the first in their list and that are within the music path
+        delete_redundant_files(redundancies, folder=MUSIC_PATH, delete_near_duplicates=DELETE_NEAR_DUPLICATES) # delete all that are not the first in their list and that are within the music path
+    extinfs = None
+    extinfs_rel = None
+    if EXTENDED_M3U:
+        tag_cache = TagCache(db_path=CACHE_DB_PATH, rebuild=False) if USE_TAG_CACHE else None
+        extinfs = collect_extinfs(output_playlists, itertools.chain(local_music_file_infos, fallback_index.file_infos), tag_cache=tag_cache, copied=copied)
+        if tag_cache is not None:
+            tag_cache.close()
+    written_playlist_store = WrittenPlaylistStore(db_path=CACHE_DB_PATH) if USE_WRITTEN_PLAYLIST_STORE else None
     if SAVE_ABSOLUTE_PLAYLISTS:
-        save_playlist_files(output_playlists, outdir=OUTPUT_PLAYLIST_DIR)
+        save_playlist_files(output_playlists, outdir=OUTPUT_PLAYLIST_DIR, store=written_playlist_store, extinfs=extinfs)
     if MAKE_PLAYLISTS_RELATIVE_TO_OUTPUT_PLAYLIST_DIR:
         output_playlists_rel=relativate_playlists(output_playlists, relative_to=OUTPUT_PLAYLIST_DIR_RELATIVE)
-        save_playlist_files(output_playlists_rel, outdir=OUTPUT_PLAYLIST_DIR_RELATIVE)
+        if extinfs is not None:
+            # the relative playlists have the same entries in the same order
+            extinfs_rel = { rel_line: extinfs[abs_line] for abs_playlist, rel_playlist in zip(output_playlists, output_playlists_rel)
+                    for abs_line, rel_line in zip(abs_playlist.get_content(), rel_playlist.get_content()) if abs_line in extinfs }
+        save_playlist_files(output_playlists_rel, outdir=OUTPUT_PLAYLIST_DIR_RELATIVE, store=written_playlist_store, extinfs=extinfs_rel)
+    if written_playlist_store is not None:
+        written_playlist_store.close()
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
@@ -985,6 +3058,10 @@ if __name__ == '__main__':
             print("hello. Specify some things in the source file with the CAPS LOCKED variables!")
             print("If you're running this in Windows CMD, you might need to `set PYTHONIOENCODING=utf-8` first.")
             print("It is probably advisable to pipe the stdout into a file so that the important messages from STDERR surface clearly.")
+            print("`python convert.py ingest` reads the Takeout playlists again, e.g. after replacing the export with a new one.")
+            exit(0)
+        if sys.argv[1] == 'ingest':
+            ingest_takeout()
             exit(0)
         if sys.argv[1] == 'here':
             print("using current directory {} as MUSIC_PATH".format(os.getcwd()))
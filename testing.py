@@ -1,6 +1,8 @@
 # A test file to be run after code modifications
 # `py.test testing.py`
 
+import pytest
+
 from convert import *
 
 def test_setpartsequal1():
@@ -10,3 +12,526 @@ def test_setpartsequal1():
 def test_setpartsequal2():
     ar="artist"; al="ALBUM"; tit="";
     assert FileTag(ar,al,tit).set_parts_equal(artist=ar, album=al, title=tit)
+
+def test_tagindex_same_first_hit_as_linear_scan():
+    tags = [FileTag("", "", ""), FileTag("a", "", "t"), FileTag("a", "al", "t"), FileTag("", "al", "t"), FileTag("b", "al", "t")]
+    infos = [FileInfo(full_path="/m/{}".format(i), filename=str(i), tag=tag) for i, tag in enumerate(tags)]
+    index = TagIndex(infos)
+    for artist in ["a", "b", ""]:
+        for album in ["al", "x", ""]:
+            for title in ["t", ""]:
+                linear = next((i for i in infos if i.is_tag_set() and i.tag.set_parts_equal(artist=artist, title=title, album=album)), None)
+                assert index.find_exact(artist=artist, title=title, album=album) is linear
+
+def test_tagcache_roundtrip(tmp_path):
+    music_file = tmp_path / "song.mp3"
+    music_file.write_bytes(b"not really music")
+    info = FileInfo(full_path=str(music_file), filename="song.mp3", tag=FileTag("artist", "album", "title"))
+    cache = TagCache(db_path=str(tmp_path / "cache.sqlite3"))
+    cache.store(info, file_signature(info.full_path))
+    cache.close()
+
+    cached = FileInfo(full_path=str(music_file), filename="song.mp3")
+    cache = TagCache(db_path=str(tmp_path / "cache.sqlite3"))
+    assert cache.load(cached, file_signature(cached.full_path))
+    assert cached.tag == info.tag
+    assert not cache.load(cached, (0, 0))
+    cache.close()
+    assert not TagCache(db_path=str(tmp_path / "cache.sqlite3"), rebuild=True).load(cached, file_signature(cached.full_path))
+
+def test_parallel_tag_indexing_matches_serial(tmp_path):
+    from mutagen.easyid3 import EasyID3
+    paths = []
+    for i in range(12):
+        path = str(tmp_path / "song{}.mp3".format(i))
+        with open(path, "wb") as f:
+            f.write(b"\0" * 64)
+        if i % 3:
+            tag = EasyID3()
+            tag["artist"] = "artist {}".format(i)
+            tag["title"] = "title &amp; {}".format(i)
+            tag.save(path)
+        paths.append(path)
+    results = []
+    for workers, use_processes in [(1, False), (4, False), (2, True)]:
+        infos = [FileInfo(full_path=path, filename=os.path.basename(path)) for path in paths]
+        update_tags_from_fs(infos, workers=workers, use_processes=use_processes)
+        results.append([info.tag for info in infos])
+    assert results[0] == results[1] == results[2]
+    assert results[0][1] == FileTag(artist="artist 1", album="", title="title & 1")
+
+def test_hashstore_validates_and_prunes(tmp_path):
+    music_file = tmp_path / "song.mp3"
+    music_file.write_bytes(b"abc")
+    store = HashStore(db_path=str(tmp_path / "cache.sqlite3"))
+    store.put(str(music_file), "somehash")
+    store.close()
+
+    store = HashStore(db_path=str(tmp_path / "cache.sqlite3"))
+    assert store.get(str(music_file)) == "somehash"
+    music_file.write_bytes(b"abcd")
+    assert store.get(str(music_file)) is None
+    music_file.unlink()
+    assert store.prune() == 1
+    assert store.entries == {}
+
+def test_tiered_dedup_finds_same_redundancies(tmp_path, monkeypatch):
+    import convert
+    monkeypatch.setattr(convert, "DUMP_REDUNDANCIES_AS_JSON_TO_OUTPUT_PLAYLIST_DIR", False)
+    monkeypatch.setattr(convert, "USE_HASH_STORE", False)
+    contents = [b"a" * 300000, b"b" * 10, b"a" * 300000, b"a" * 299999 + b"b", b"a" * 150000 + b"c" + b"a" * 149999, b"b" * 10, b"c"]
+    infos = []
+    for i, content in enumerate(contents):
+        path = tmp_path / "{}.mp3".format(i)
+        path.write_bytes(content)
+        infos.append(FileInfo(full_path=str(path), filename=path.name))
+    full = compute_redundant_files(infos, tiered=False)
+    tiered = compute_redundant_files(infos, tiered=True)
+    assert full == tiered
+    assert sorted(map(sorted, tiered.values())) == [[infos[0].full_path, infos[2].full_path], [infos[1].full_path, infos[5].full_path]]
+
+def test_hash_algorithms_are_not_mixed(tmp_path, monkeypatch):
+    import convert, hashlib
+    music_file = tmp_path / "song.mp3"
+    music_file.write_bytes(b"some bytes" * 1000)
+    store = HashStore(db_path=str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(convert.HashCacheSingleton, "filehashes", {})
+    monkeypatch.setattr(convert.HashCacheSingleton, "store", store)
+    assert hash_file(str(music_file), algorithm="md5") == hashlib.md5(music_file.read_bytes()).hexdigest()
+    assert hash_files([str(music_file)], algorithm="blake2b", workers=2) == [hashlib.blake2b(music_file.read_bytes()).hexdigest()]
+    assert store.get(str(music_file), algorithm="md5") == hashlib.md5(music_file.read_bytes()).hexdigest()
+    assert store.get(str(music_file), algorithm="sha1") is None
+
+def test_audio_only_hash_ignores_tags(tmp_path, monkeypatch):
+    import convert
+    from mutagen.easyid3 import EasyID3
+    monkeypatch.setattr(convert, "DUMP_REDUNDANCIES_AS_JSON_TO_OUTPUT_PLAYLIST_DIR", False)
+    monkeypatch.setattr(convert, "USE_HASH_STORE", False)
+    audio = bytes(range(256)) * 1000
+    infos = []
+    for i, title in enumerate(["first", "second title"]):
+        path = str(tmp_path / "{}.mp3".format(i))
+        with open(path, "wb") as f:
+            f.write(audio)
+        tag = EasyID3()
+        tag["title"] = title
+        tag.save(path)
+        with open(path, "ab") as f:
+            f.write(b"TAG" + title.encode().ljust(125, b"\0"))
+        infos.append(FileInfo(full_path=path, filename=os.path.basename(path)))
+    flac_path = str(tmp_path / "2.flac")
+    with open(flac_path, "wb") as f:
+        f.write(b"fLaC" + bytes([0x80, 0, 0, 3]) + b"xyz" + audio)
+    infos.append(FileInfo(full_path=flac_path, filename="2.flac"))
+
+    assert compute_redundant_files(infos, audio_only=False) == {}
+    for tiered in (True, False):
+        redundancies = compute_redundant_files(infos, tiered=tiered, audio_only=True)
+        assert [sorted(redlist) for redlist in redundancies.values()] == [sorted(info.full_path for info in infos)]
+
+def test_contains_index_gives_same_matches():
+    import random
+    rng = random.Random(4)
+    words = ["love", "the", "a", "night", "rock", "x", "blue", "&amp;", "café", "on"]
+    make = lambda: " ".join(rng.choice(words) for _ in range(rng.randint(0, 3)))
+    infos = []
+    for i in range(200):
+        tag = FileTag(artist=make(), album=make(), title=make()) if i % 7 else None
+        infos.append(FileInfo(full_path="/music/{}/{}_{}.mp3".format(make(), make(), i), filename="{}_{}.mp3".format(make(), i), tag=tag))
+    index = ContainsIndex(infos)
+    library_index = ContainsIndex(LibraryIndex.from_file_infos(infos))
+    for _ in range(200):
+        song = SongInfo(title=make(), artist=make(), album=make(), liked=False, title_stripped="")
+        for matcher in (tags_contain_info, filepath_contains_info):
+            results = []
+            for contains_index in (None, index, library_index):
+                playlist = Playlist(name="p")
+                try:
+                    found = matcher(infos, song, MatchTracker(), playlist=playlist, contains_index=contains_index)
+                except Exception as e: # best_bitrate_file can't read the fake files
+                    found = type(e)
+                results.append((found, playlist.get_content()))
+            assert results[0] == results[1] == results[2]
+
+def test_songinfo_normalized_forms_do_not_change_repr_or_equality():
+    song = SongInfo(title="Rock &amp; Roll_Night", artist="Me", liked=True, album="", title_stripped="x")
+    assert repr(song) == "SongInfo(title='Rock &amp; Roll_Night', artist='Me', liked=True, album='', title_stripped='x')"
+    assert song.title_tokens == ("rock", "roll", "night")
+    assert song == SongInfo(title="Rock &amp; Roll_Night", artist="Me", liked=True, album="", title_stripped="x")
+    info = FileInfo(full_path="/m/a.mp3", filename="a.mp3", tag=FileTag(artist="me", album="", title="Rock & Roll Night!"))
+    assert fuzzily_contains(info.get_normalized().title, song.title_tokens) == x_fuzzily_contains_y(info.tag.title, song.title)
+
+def test_similarity_engine_exact_matches_difflib():
+    import random, difflib
+    rng = random.Random(3)
+    words = ["love", "night", "rock", "blue", "- ", "01 ", ".mp3", "a", "ab"]
+    make = lambda: "".join(rng.choice(words) for _ in range(rng.randint(0, 4)))
+    possibilities = [make() for _ in range(300)]
+    engine = SimilarityEngine(possibilities, method="exact")
+    trigram_engine = SimilarityEngine(possibilities, method="trigram")
+    for _ in range(100):
+        query = make()
+        for cutoff in (0.0, 0.3, 0.6, 0.9):
+            expected = difflib.get_close_matches(query, possibilities, n=1, cutoff=cutoff)
+            assert engine.best_match(query, cutoff) == (expected[0] if expected else None)
+            found = trigram_engine.best_match(query, cutoff)
+            assert found is None or difflib.SequenceMatcher(None, found, query).ratio() >= cutoff
+
+def test_replayed_decisions_keep_statistics():
+    infos = [FileInfo(full_path="/m/a.mp3", filename="a.mp3", tag=FileTag(artist="me", album="", title="song"))]
+    fallback = [FileInfo(full_path="/f/b.mp3", filename="b.mp3", tag=FileTag(artist="", album="", title="long"))]
+    fallback_index = FallbackIndex(["/f"], [fallback])
+    fallback_index.build_lookups()
+    context = MatchContext(local_music_file_infos=infos, local_tag_index=TagIndex(infos), local_contains_index=ContainsIndex(infos),
+            fallback_index=fallback_index)
+    songs = [SongInfo(title=t, artist=a, liked=False, album="", title_stripped=t) for t, a in [("song", "me"), ("long title", "x"), ("nothing", "x")]]
+    trackers = []
+    for cache in (None, {}):
+        tracker, fallback_tracker, playlist = MatchTracker(), MatchTracker(), Playlist(name="p")
+        for song in songs * 2:
+            decision = cache.get(song) if cache is not None else None
+            if decision is None:
+                decision = resolve_song(song, context)
+                if cache is not None:
+                    cache[song] = decision
+            apply_decision(decision, song, tracker, fallback_tracker, playlist, "p")
+        trackers.append((tracker, fallback_tracker, playlist))
+    assert trackers[0] == trackers[1]
+    tracker, fallback_tracker, playlist = trackers[1]
+    assert tracker.match_counts == {MatchSource.EXACT_TAG_MATCH: 2, MatchSource.UNMATCHED: 2}
+    assert fallback_tracker.match_counts == {MatchSource.SUBSTRING_TAG_MATCH: 2}
+    assert playlist.content[:2] == ["/m/a.mp3", "/f/b.mp3"]
+
+def test_fallback_index_searches_all_roots_like_linear_scan(tmp_path):
+    import random
+    roots = [str(tmp_path / "first"), str(tmp_path / "second")]
+    for root, names in zip(roots, [["a.mp3", "b.mp3"], ["c.mp3"]]):
+        os.makedirs(root)
+        for name in names:
+            open(os.path.join(root, name), "wb").close()
+    index = FallbackIndex.from_roots(roots, workers=2)
+    assert index.files_per_root() == {roots[0]: 2, roots[1]: 1}
+    assert [index.root_of(i) for i in range(3)] == [roots[0], roots[0], roots[1]]
+
+    rng = random.Random(3)
+    words = ["", "a", "b", "ab", "ba", "long title"]
+    infos = [FileInfo(full_path="/f/{}.mp3".format(i), filename="{}.mp3".format(i), tag=FileTag(*(rng.choice(words) for _ in range(3))) if i % 7 else None) for i in range(300)]
+    index = FallbackIndex(["/f", "/g"], [infos[:150], infos[150:]])
+    index.build_lookups()
+    for _ in range(300):
+        song = SongInfo(title=rng.choice(words) + rng.choice(words), artist=rng.choice(words), album=rng.choice(words), liked=False, title_stripped="")
+        expected = DecisionRecorder()
+        found = DecisionRecorder()
+        assert find_substring_tag_match(infos, song, expected, None) == find_substring_tag_match(None, song, found, None, fallback_index=index)
+        assert expected.decision == found.decision
+        expected = DecisionRecorder()
+        find_exact_tag_match(infos, song, expected, None)
+        assert (expected.decision.path if expected.decision else None) == (index.find_exact(song).full_path if index.find_exact(song) else None)
+
+def test_substring_automaton_finds_all_contained_patterns():
+    import random
+    rng = random.Random(5)
+    make = lambda n: "".join(rng.choice("abc") for _ in range(rng.randint(0, n)))
+    for _ in range(50):
+        patterns = list(dict.fromkeys(make(4) for _ in range(20)))
+        automaton = SubstringAutomaton(patterns)
+        for _ in range(20):
+            text = make(12)
+            assert automaton.find_all(text) == { number for number, pattern in enumerate(patterns) if pattern in text }
+
+def test_library_index_behaves_like_file_infos(tmp_path):
+    from mutagen.easyid3 import EasyID3
+    song = str(tmp_path / "song.mp3")
+    write_mp3(song)
+    tag = EasyID3()
+    tag["title"] = "lazy"
+    tag.save(song)
+    infos = [FileInfo(full_path="/m/a/1.mp3", filename="1.mp3", tag=FileTag(artist="me", album="", title="song"), audio_info=AudioInfo(128000, 3.5, "mp3", 44100)),
+            FileInfo(full_path="/m/a/2.mp3", filename="2.mp3", tag=FileTag(artist="me", album="x", title="long song title")),
+            FileInfo(full_path="/m/b/3.jpg", filename="3.jpg", tag=None),
+            FileInfo(full_path="/m/4.mp3", filename="other name", tag=FileTag(artist="", album="", title="")),
+            FileInfo(full_path=song, filename="song.mp3")]
+    library = LibraryIndex.from_file_infos(infos)
+    assert len(library) == 5 and len(library.folders) == 4
+    assert [(e.full_path, e.filename, e.get_plain_filename()) for e in library] == [(i.full_path, i.filename, i.get_plain_filename()) for i in infos]
+    assert not library[-1].is_tag_loaded()
+    assert [e.tag for e in library] == [i.tag for i in infos] and library[-1].is_tag_loaded()
+    assert [e.is_tag_set() for e in library] == [i.is_tag_set() for i in infos]
+    assert [e.audio_info for e in library] == [i.audio_info for i in infos]
+    assert [e.get_normalized() for e in library] == [i.get_normalized() for i in infos]
+    library[1].tag = FileTag(artist="you", album="", title="song")
+    assert library[1].tag.artist == "you" and library[1].get_normalized().artist == "you"
+    infos[1].tag = FileTag(artist="you", album="", title="song")
+
+    songs = [SongInfo(title=t, artist=a, liked=False, album="", title_stripped=t) for t, a in [("song", "you"), ("song", "me"), ("lazy", ""), ("nothing", "x")]]
+    for song in songs:
+        assert resolve_song(song, build_match_context(library, [])) == resolve_song(song, build_match_context(infos, []))
+
+    # the libraries of the fallback roots are merged into one, without creating views
+    fallback_index = FallbackIndex(["/a", "/b"], [LibraryIndex.from_file_infos(infos[:2]), LibraryIndex.from_file_infos(infos[2:])])
+    assert isinstance(fallback_index.file_infos, LibraryIndex) and list(fallback_index.priorities) == [0, 0, 1, 1, 1]
+    assert [(e.full_path, e.filename, e.tag, e.audio_info) for e in fallback_index.file_infos] == [(i.full_path, i.filename, i.tag, i.audio_info) for i in infos]
+    for song in songs:
+        assert resolve_song(song, build_match_context([], fallback_index)) == resolve_song(song, build_match_context([], infos))
+
+def test_unchanged_playlists_are_not_written_again(tmp_path):
+    outdir = str(tmp_path / "out")
+    first = Playlist(name="first", content=["/m/a.mp3", "/m/ä.mp3"])
+    second = Playlist(name="second", content=[])
+    first_path, second_path = os.path.join(outdir, "first.m3u"), os.path.join(outdir, "second.m3u")
+    for store in (None, WrittenPlaylistStore(db_path=str(tmp_path / "cache.sqlite3"))):
+        save_playlist_files([first, second], outdir=outdir, store=store)
+        with open(first_path, encoding="utf-8") as infile:
+            assert infile.read() == "/m/a.mp3\n/m/ä.mp3\n"
+        inodes = os.stat(first_path).st_ino, os.stat(second_path).st_ino
+        second.content = ["/m/b.mp3"]
+        save_playlist_files([first, second], outdir=outdir, store=store)
+        # a written file is a new file that replaced the old one
+        assert os.stat(first_path).st_ino == inodes[0] and os.stat(second_path).st_ino != inodes[1]
+        second.content = []
+    # a file that was changed by someone else is written again
+    with open(first_path, "a", encoding="utf-8") as outfile:
+        outfile.write("/m/c.mp3\n")
+    save_playlist_files([first], outdir=outdir, store=store)
+    with open(first_path, encoding="utf-8") as infile:
+        assert infile.read() == "/m/a.mp3\n/m/ä.mp3\n"
+    store.close()
+    assert sorted(os.listdir(outdir)) == ["first.m3u", "second.m3u"]
+
+def test_extended_m3u_uses_known_tags_and_lengths(tmp_path):
+    infos = [FileInfo(full_path="/m/a.mp3", filename="a.mp3", tag=FileTag(artist="me", album="", title="song"), audio_info=AudioInfo(128000, 181.6, "mp3", 44100)),
+            FileInfo(full_path="/m/b.mp3", filename="b.mp3", tag=FileTag(artist="", album="", title="")),
+            FileInfo(full_path="/m/not read.mp3", filename="not read.mp3")]
+    playlist = Playlist(name="p", content=["/m/a.mp3", "/m/copy.mp3", "/m/b.mp3", "/m/not read.mp3"])
+    extinfs = collect_extinfs([playlist], infos, copied={"/m/copy.mp3": "/m/a.mp3"})
+    assert not infos[2].is_tag_loaded()
+    assert extinfs == {"/m/a.mp3": "#EXTINF:182,me - song", "/m/copy.mp3": "#EXTINF:182,me - song", "/m/b.mp3": "#EXTINF:-1,b"}
+    save_playlist_files([playlist], outdir=str(tmp_path), extinfs=extinfs)
+    with open(str(tmp_path / "p.m3u"), encoding="utf-8") as infile:
+        assert infile.read() == "#EXTM3U\n#EXTINF:182,me - song\n/m/a.mp3\n#EXTINF:182,me - song\n/m/copy.mp3\n#EXTINF:-1,b\n/m/b.mp3\n/m/not read.mp3\n"
+
+def test_extended_m3u_takes_unloaded_tags_from_the_tag_cache(tmp_path):
+    song = str(tmp_path / "song.mp3")
+    write_mp3(song, frames=100)
+    tag_cache = TagCache(db_path=str(tmp_path / "cache.sqlite3"))
+    known = FileInfo(full_path=song, filename="song.mp3", tag=FileTag(artist="", album="", title="cached"))
+    known.get_audio_info()
+    tag_cache.store(known, file_signature(song))
+    unknown = FileInfo(full_path=song, filename="song.mp3")
+    assert collect_extinfs([Playlist(name="p", content=[song])], [unknown], tag_cache=tag_cache) == {song: "#EXTINF:3,cached"}
+    tag_cache.close()
+
+def test_relativate_playlists_converts_each_path_once():
+    playlists = [Playlist(name="a", content=["/m/x/1.mp3", "/m/2.mp3"]), Playlist(name="b", content=["/m/2.mp3", "/m/x/1.mp3"])]
+    relative = relativate_playlists(playlists, relative_to="/m/x")
+    assert [p.content for p in relative] == [["1.mp3", "../2.mp3"], ["../2.mp3", "1.mp3"]]
+
+def test_matchstore_keeps_decisions_while_files_exist(tmp_path):
+    music_file = tmp_path / "song.mp3"
+    music_file.write_bytes(b"x")
+    song = SongInfo(title="Song (Live)", artist="me", liked=False, album="", title_stripped="Song")
+    other = SongInfo(title="other", artist="me", liked=False, album="", title_stripped="other")
+    decision = MatchDecision(song_info=song.with_swapped_titles(), path=str(music_file), match_source=MatchSource.TAGS_CONTAIN)
+    store = MatchStore(db_path=str(tmp_path / "cache.sqlite3"))
+    store.put(song, decision)
+    store.put(other, MatchDecision(song_info=None, path=None, match_source=MatchSource.UNMATCHED))
+    store.put_user_specified(MatchStore.key_of(other), str(music_file))
+    store.close()
+    store = MatchStore(db_path=str(tmp_path / "cache.sqlite3"))
+    assert store.get(song) == decision
+    assert store.get(other).match_source == MatchSource.USER_SPECIFIED
+    music_file.unlink()
+    assert store.get(song) is None
+    assert MatchStore(db_path=str(tmp_path / "cache.sqlite3"), rebuild=True).entries == {}
+
+def test_parallel_matching_matches_serial():
+    infos = [FileInfo(full_path="/m/{}.mp3".format(i), filename="{}.mp3".format(i), tag=FileTag(artist="a{}".format(i % 7), album="", title="song {}".format(i))) for i in range(300)]
+    context = build_match_context(infos, [])
+    songs = [SongInfo(title="song {}".format(i), artist="a{}".format(i % 5), liked=False, album="", title_stripped="song {}".format(i)) for i in range(0, 400, 3)]
+    assert resolve_songs(songs, context, workers=3) == resolve_songs(songs, context, workers=1)
+
+def test_gpm_playlist_sorted_by_numeric_index(tmp_path):
+    tracks = tmp_path / "PL" / "Tracks"
+    tracks.mkdir(parents=True)
+    for i in [2, 10, 1]:
+        (tracks / "song{}.csv".format(i)).write_text('Title,Album,Artist,Duration (ms),Rating,Play Count,Removed,Playlist Index\n"t{}","al","ar &amp; co","1","5","1","","{}"\n'.format(i, i), encoding="utf-8")
+    (tracks / "broken.csv").write_bytes(b'\xff\xfe')
+    songs = read_gpm_playlist(str(tmp_path / "PL"))
+    assert [song.title for song in songs] == ["t1", "t2", "t10"]
+    assert songs[0].artist == "ar & co" and songs[0].liked
+    assert list(read_gpm_songlists([("a", list_gpm_track_csvs(str(tmp_path / "PL")))], workers=1)) == [("a", songs)]
+
+def test_takeout_store_loads_what_was_read(tmp_path):
+    def add_song(tracks, i):
+        (tracks / "{}.csv".format(i)).write_text('Title,Album,Artist,Duration (ms),Rating,Play Count,Removed,Playlist Index\n"t{}","al","ar","1","","1","","{}"\n'.format(i, i), encoding="utf-8")
+    for name in ["PL", "Empty"]:
+        (tmp_path / name / "Tracks").mkdir(parents=True)
+        (tmp_path / name / "Metadata.csv").write_text("x")
+    (tmp_path / "Thumbs up").mkdir()
+    for i in range(3):
+        add_song(tmp_path / "PL" / "Tracks", i)
+        add_song(tmp_path / "Thumbs up", i)
+    db_path = str(tmp_path / "cache.sqlite3")
+    songlists = read_takeout(str(tmp_path), db_path=db_path, workers=1)
+    assert songlists == read_takeout(str(tmp_path), use_store=False, workers=1)
+    assert sorted(name for name, _song_infos in songlists[:-1]) == ["Empty", "PL"] and songlists[-1][0] == "Thumbs up"
+    fingerprint = lambda: takeout_fingerprint(str(tmp_path), scan_takeout_track_csvs(list_takeout_playlists(str(tmp_path))))
+    assert TakeoutStore(db_path).load(fingerprint()) == songlists
+    add_song(tmp_path / "PL" / "Tracks", 3)
+    assert TakeoutStore(db_path).load(fingerprint()) is None
+    assert len(dict(read_takeout(str(tmp_path), db_path=db_path, workers=1))["PL"]) == 4
+    # a new export extracted over the old one only changes the contents of the files
+    tracks = tmp_path / "PL" / "Tracks"
+    folder_mtime = os.stat(str(tracks)).st_mtime_ns
+    (tracks / "0.csv").write_text('Title,Album,Artist,Duration (ms),Rating,Play Count,Removed,Playlist Index\n"new","al","ar","1","","1","","0"\n', encoding="utf-8")
+    os.utime(str(tracks), ns=(folder_mtime, folder_mtime))
+    assert TakeoutStore(db_path).load(fingerprint()) is None
+    assert "new" in [song.title for song in dict(read_takeout(str(tmp_path), db_path=db_path, workers=1))["PL"]]
+
+def test_tags_are_read_lazily_and_only_from_audio_files(tmp_path):
+    from mutagen.easyid3 import EasyID3
+    song = str(tmp_path / "song")
+    with open(song, "wb") as f:
+        f.write(b"\0" * 64)
+    tag = EasyID3()
+    tag["title"] = "title"
+    tag.save(song)
+    cover = tmp_path / "cover.jpg"
+    cover.write_bytes(b"ID3 but still a picture")
+    (tmp_path / "notes").write_text("hello")
+    assert looks_like_audio_file(song) and not looks_like_audio_file(str(cover)) and not looks_like_audio_file(str(tmp_path / "notes"))
+    info = FileInfo(full_path=song, filename="song")
+    assert not info.is_tag_loaded()
+    assert info.tag == FileTag(artist="", album="", title="title") and info.is_tag_loaded()
+    assert FileInfo(full_path=str(cover), filename="cover.jpg").tag is None
+    assert FileInfo(full_path="/does/not/exist.mp3", filename="exist.mp3", tag=None).tag is None
+    missing = FileInfo(full_path="/does/not/exist.mp3", filename="exist.mp3")
+    assert "not loaded" in repr(missing) and missing == FileInfo(full_path="/does/not/exist.mp3", filename="exist.mp3") and not missing.is_tag_loaded()
+    assert missing.tag is None and missing.audio_info == UNKNOWN_AUDIO_INFO
+
+def test_walk_files_reuses_unchanged_folders(tmp_path):
+    music = tmp_path / "music"
+    for folder in ["a/b", "a/@eaDir/x", "c"]:
+        os.makedirs(str(music / folder))
+    for path in ["top.mp3", "a/1.mp3", "a/b/2.mp3", "a/@eaDir/thumb.jpg", "a/@eaDir/x/3.mp3", "c/4.mp3"]:
+        (music / path).write_bytes(b"")
+    root = str(music)
+    expected = [os.path.join(d, f) for (d, _dirs, fs) in os.walk(root) for f in fs if not is_ignored(d)]
+    db_path = str(tmp_path / "cache.sqlite3")
+    index = DirectoryIndex(db_path=db_path)
+    assert walk_files(root, dir_index=index, ignored=["@eaDir"]) == expected == walk_files(root, ignored=["@eaDir"])
+    assert index.listed == 4 and index.reused == 0
+    index.close()
+    (music / "a" / "b" / "5.mp3").write_bytes(b"")
+    os.utime(str(music / "a" / "b"), ns=(0, 10**9))
+    index = DirectoryIndex(db_path=db_path)
+    expected = [os.path.join(d, f) for (d, _dirs, fs) in os.walk(root) for f in fs if not is_ignored(d)]
+    assert os.path.join(root, "a", "b", "5.mp3") in expected
+    assert walk_files(root, dir_index=index, ignored=["@eaDir"]) == expected
+    assert index.listed == 1 and index.reused == 3
+    assert walk_files(os.path.join(root, "a", "@eaDir"), ignored=["@eaDir"]) == []
+
+def write_mp3(path, frames=20, bitrate_index=9):
+    # MPEG-1 Layer III, 44.1 kHz frames. bitrate_index 9 is 128 kbps, 11 is 192 kbps
+    kbps = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320][bitrate_index]
+    frame = bytes([0xFF, 0xFB, (bitrate_index << 4), 0x64]) + b"\0" * (144 * kbps * 1000 // 44100 - 4)
+    with open(path, "wb") as f:
+        f.write(frame * frames)
+
+def write_flac(path, seconds=3):
+    import struct
+    streaminfo = struct.pack(">HH", 4096, 4096) + b"\0" * 6 + ((44100 << 44) | (1 << 41) | (15 << 36) | (44100 * seconds)).to_bytes(8, "big") + b"\0" * 16
+    with open(path, "wb") as f:
+        f.write(b"fLaC" + bytes([0x80]) + len(streaminfo).to_bytes(3, "big") + streaminfo + b"\0" * 1000)
+
+def test_audio_info_is_read_with_the_tag_and_cached(tmp_path):
+    from mutagen.easyid3 import EasyID3
+    low, high, flac = str(tmp_path / "low.mp3"), str(tmp_path / "high.mp3"), str(tmp_path / "a.flac")
+    write_mp3(low)
+    write_mp3(high, bitrate_index=11)
+    write_flac(flac)
+    tag = EasyID3()
+    tag["title"] = "t"
+    tag.save(high)
+    infos = [FileInfo(full_path=path, filename=os.path.basename(path)) for path in (low, high, flac)]
+    cache = TagCache(db_path=str(tmp_path / "cache.sqlite3"))
+    update_tags_from_fs(infos, tag_cache=cache, workers=1)
+    cache.close()
+    assert [info.audio_info.codec for info in infos] == ["mp3", "mp3", "flac"]
+    assert infos[1].tag.title == "t" and infos[1].audio_info.bitrate == 192000 and infos[1].audio_info.sample_rate == 44100
+    assert infos[2].audio_info.length == 3.0
+    cached = [FileInfo(full_path=path, filename=os.path.basename(path)) for path in (low, high, flac)]
+    cache = TagCache(db_path=str(tmp_path / "cache.sqlite3"))
+    update_tags_from_fs(cached, tag_cache=cache, workers=1)
+    assert cache.misses == 0 and [info.audio_info for info in cached] == [info.audio_info for info in infos]
+    for path in (low, high, flac):
+        os.remove(path)
+    assert best_bitrate_file(cached[:2]) is cached[1]
+
+def test_id3_tag_in_front_of_a_flac_file_is_not_read_as_mp3(tmp_path):
+    from mutagen.easyid3 import EasyID3
+    flac = str(tmp_path / "a.flac")
+    write_flac(flac)
+    mp3 = str(tmp_path / "frames")
+    write_mp3(mp3)
+    with open(flac, "ab") as f, open(mp3, "rb") as frames:
+        f.write(frames.read()) # data that looks like MPEG frames
+    with open(flac, "rb") as f:
+        data = f.read()
+    tag = EasyID3()
+    tag["title"] = "t"
+    tag.save(flac)
+    with open(flac, "rb") as f:
+        assert f.read().endswith(data)
+    info = FileInfo(full_path=flac, filename="a.flac")
+    assert info.tag.title == "t" and info.audio_info.codec == "flac" and info.audio_info.length == 3.0
+
+def test_rank_redundancies_keeps_the_best_file():
+    def info(path, codec="mp3", bitrate=128000, tag=None):
+        file_info = FileInfo(full_path=path, filename=os.path.basename(path), tag=tag)
+        file_info.audio_info = AudioInfo(bitrate=bitrate, length=200.0, codec=codec, sample_rate=44100)
+        return file_info
+    infos = [info("/m/a.mp3"), info("/m/fallback/b.mp3", bitrate=192000),
+            info("/m/fallback/c.mp3"), info("/m/copy of c.mp3"),
+            info("/m/d.mp3", bitrate=320000), info("/m/fallback/d.flac", codec="flac", bitrate=900000),
+            info("/m/e.mp3"), info("/m/e (1).mp3", tag=FileTag(artist="x", album="", title="e"))]
+    redundancies = {"1": [infos[0].full_path, infos[1].full_path], "2": [infos[2].full_path, infos[3].full_path],
+            "3": [infos[4].full_path, infos[5].full_path], "4": [infos[6].full_path, infos[7].full_path]}
+    ranked, report = rank_redundancies(redundancies, { i.full_path: i for i in infos }, avoid_folders=["/m/fallback"])
+    assert [redlist[0] for redlist in ranked.values()] == ["/m/fallback/b.mp3", "/m/copy of c.mp3", "/m/fallback/d.flac", "/m/e (1).mp3"]
+    assert [entry["reason"] for entry in report] == ["higher bitrate", "not in DEDUP_AVOID_FOLDERS", "lossless", "more complete tags"]
+    assert sorted(ranked["1"]) == sorted(redundancies["1"])
+
+@pytest.mark.skipif(os.name != "posix", reason="the fake fpcalc is a shell script")
+def test_near_duplicates_by_fingerprint(tmp_path, monkeypatch):
+    import convert, random, sys
+    monkeypatch.setattr(convert, "DUMP_REDUNDANCIES_AS_JSON_TO_OUTPUT_PLAYLIST_DIR", False)
+    monkeypatch.setattr(convert, "USE_HASH_STORE", False)
+    monkeypatch.setattr(convert, "USE_TAG_CACHE", False)
+    # instead of decoding audio, the fake fpcalc prints what is written in the file
+    fpcalc = tmp_path / "fpcalc"
+    fpcalc.write_text("#!{}\nimport sys\nsys.stdout.write(open(sys.argv[-1]).read())\n".format(sys.executable))
+    fpcalc.chmod(0o755)
+    monkeypatch.setattr(convert, "FPCALC_PATH", str(fpcalc))
+    rng = random.Random(3)
+    song = [rng.getrandbits(32) for _ in range(900)]
+    reencoded = [value ^ (1 << rng.randrange(32)) if rng.random() < 0.3 else value for value in song[3:]]
+    other = [rng.getrandbits(32) for _ in range(900)]
+    paths = []
+    for name, duration, fingerprint in [("song.mp3", 200, song), ("song.flac", 197, reencoded), ("other.mp3", 200, other), ("copy.mp3", 200, song)]:
+        path = str(tmp_path / name)
+        with open(path, "w") as f:
+            f.write("DURATION={}\nFINGERPRINT={}\n".format(duration, ",".join(map(str, fingerprint))))
+        paths.append(path)
+    assert fingerprint_similarity(song, reencoded) > 0.95 and fingerprint_similarity(song, other) < 0.6
+    infos = [FileInfo(full_path=path, filename=os.path.basename(path), tag=None) for path in paths]
+    for info, codec in zip(infos, ["mp3", "flac", "mp3", "mp3"]):
+        info.audio_info = AudioInfo(bitrate=900000 if codec == "flac" else 128000, length=200.0, codec=codec, sample_rate=44100)
+    monkeypatch.setattr(convert, "CACHE_DB_PATH", str(tmp_path / "cache.sqlite3"))
+    redundancies = compute_redundant_files(infos, fingerprints=True, avoid_folders=[])
+    near = [redlist for key, redlist in redundancies.items() if key.startswith(NEAR_DUPLICATE_PREFIX)]
+    assert near == [[paths[1], paths[3]]] # song.mp3 is only in the group of equal files, copy.mp3 is kept there
+    playlist = Playlist(name="p", content=[paths[0], paths[2]])
+    assert update_playlists([playlist], redundancies)[0].content == [paths[1], paths[2]]
+    known, result = FingerprintStore(db_path=str(tmp_path / "cache.sqlite3")).get(paths[3], file_signature(paths[3]))
+    assert known and list(result[1]) == song